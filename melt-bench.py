@@ -0,0 +1,286 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: set ts=4 sw=4 et:
+
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+MELT probe benchmark
+
+Generates a synthetic MELT session and pushes it through a pipe into the
+real probe pipeline (MeltCommunication, MeltCommandDispatcher,
+MeltSourceWindow and MeltSourceViewer), then reports throughput, peak
+memory and the latency from pipe read to painted marker, per stage, as JSON.
+"""
+
+import sys
+import os
+import imp
+import json
+import time
+import random
+import shutil
+import resource
+import tempfile
+import argparse
+import threading
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+def generate_sources(directory, files, lines):
+    filenames = []
+    for filenum in xrange(files):
+        filename = os.path.join(directory, "bench%(filenum)05d.c" % {'filenum': filenum})
+        with open(filename, 'w') as f:
+            f.writelines("int bench_%(line)d = %(line)d; /* synthetic MELT probe benchmark source */\n" % {'line': line} for line in xrange(lines))
+        filenames.append(filename)
+    return filenames
+
+def generate_session(filenames, lines, marks, infolocs, blocks, block_lines, statuses, shuffle = False, seed = 0):
+    """
+    Yield the lines of a synthetic MELT session: a SHOWFILE_PCD per file
+    followed by its MARKLOCATION_PCD marks, STARTINFOLOC_PCD/ADDINFOLOC_PCD
+    answers for the first infolocs marks of each file, and SETSTATUS_PCD
+    lines spread over the session.
+    """
+    rand = random.Random(seed)
+    total = len(filenames) * marks
+    status_every = max(total / statuses, 1) if statuses else 0
+    marknum = 0
+    for filenum, filename in enumerate(filenames):
+        yield 'SHOWFILE_PCD  "%(filename)s"  %(filenum)d' % {'filename': filename, 'filenum': filenum}
+        positions = sorted((rand.randint(1, lines), rand.randint(1, 40)) for i in xrange(marks))
+        if shuffle:
+            rand.shuffle(positions)
+        first = marknum
+        for (line, col) in positions:
+            yield "MARKLOCATION_PCD %(marknum)d %(filenum)d %(line)d %(col)d" % {'marknum': marknum, 'filenum': filenum, 'line': line, 'col': col}
+            if status_every and marknum % status_every == 0:
+                yield 'SETSTATUS_PCD  "MELT version=0.9.6-bench [synthetic_%(marknum)d]"  ' % {'marknum': marknum}
+            marknum += 1
+        for mark in xrange(first, first + min(infolocs, marks)):
+            yield "STARTINFOLOC_PCD %(marknum)d" % {'marknum': mark}
+            for block in xrange(blocks):
+                content = "".join("[bench.c : %(line)d:1] D.%(block)d = bench_%(line)d + %(mark)d;\\n" % {'line': line, 'block': block, 'mark': mark} for line in xrange(block_lines))
+                yield 'ADDINFOLOC_PCD %(marknum)d  "%(block)d:Basic Block #%(block)d Gimple Seq"   "%(content)s"  ' % {'marknum': mark, 'block': block, 'content': content}
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda p: values[min(int(len(values) * p), len(values) - 1)] * 1000
+    return {'p50_ms': pick(0.5), 'p90_ms': pick(0.9), 'p99_ms': pick(0.99), 'max_ms': values[-1] * 1000, 'count': len(values)}
+
+class BenchStats(object):
+    def __init__(self):
+        self.read_at = {}
+        self.dispatched_at = {}
+        self.painted = 0
+        self.read_to_dispatch = []
+        self.dispatch_to_paint = []
+        self.read_to_paint = []
+        # stage -> [busy seconds, items]
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def stage(self, name, elapsed, items):
+        with self.lock:
+            busy = self.stages.setdefault(name, [0.0, 0])
+            busy[0] += elapsed
+            busy[1] += items
+
+    def read(self, when, commands):
+        for command in commands:
+            if command.startswith("MARKLOCATION_PCD"):
+                self.read_at[int(command.split(None, 2)[1])] = when
+
+    def dispatched(self, when, marks):
+        for mark in marks:
+            if mark.marknum not in self.dispatched_at:
+                self.dispatched_at[mark.marknum] = when
+
+    def paint(self, when, marks, viewer):
+        for mark in marks:
+            # Marks of a file still loading are put aside and painted later
+            if viewer.marknum_to_lineindex(mark.marknum) is None or mark.marknum not in self.read_at:
+                continue
+            read = self.read_at.pop(mark.marknum)
+            dispatched = self.dispatched_at.pop(mark.marknum, read)
+            self.read_to_dispatch.append(dispatched - read)
+            self.dispatch_to_paint.append(when - dispatched)
+            self.read_to_paint.append(when - read)
+            self.painted += 1
+
+def instrument(probe, stats, open_tabs):
+    """Wrap the pipeline stages to time them and follow each mark."""
+    def timed(cls, name, stage, after = None, items = False):
+        # items: the last argument is a batch (a list or a MeltMarkView),
+        # each of its elements counts as an item of the stage
+        orig = getattr(cls, name)
+        def wrapper(self, *args):
+            start = time.time()
+            ret = orig(self, *args)
+            end = time.time()
+            stats.stage(stage, end - start, len(args[-1]) if items else 1)
+            if after:
+                after(self, end, *args)
+            return ret
+        setattr(cls, name, wrapper)
+
+    orig_queue = probe.MeltCommunication.queue_commands
+    def queue_commands(self, commands):
+        stats.read(time.time(), commands)
+        orig_queue(self, commands)
+    probe.MeltCommunication.queue_commands = queue_commands
+
+    opened = [0]
+    def open_tab(window, when, o):
+        tab = window.filemaps.get(o.filenum)
+        if tab is not None and opened[0] < open_tabs:
+            opened[0] += 1
+            tab.ensure_viewer()
+
+    timed(probe.MeltCommandDispatcher, 'slot_dispatchBatch', 'dispatch', items = True)
+    timed(probe.MeltCommandDispatcher, 'emit_marks', 'emit', lambda self, when, filenum, marks: stats.dispatched(when, marks), items = True)
+    timed(probe.MeltSourceWindow, 'slot_showfile', 'showfile', open_tab)
+    timed(probe.MeltSourceWindow, 'slot_marklocations', 'window', items = True)
+    timed(probe.MeltSourceViewer, 'mark_locations', 'paint', lambda self, when, marks: stats.paint(when, marks, self), items = True)
+
+def run(args):
+    if not os.environ.get('DISPLAY'):
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+    sys.path.insert(0, DIR)
+    probe = imp.load_source('meltprobe', os.path.join(DIR, 'simplemelt-pyqt4-probe.py'))
+    probe.logger.setLevel(probe.logging.ERROR)
+    probe.MeltSourceViewer.LARGE_FILE_THRESHOLD = args.large_file_threshold
+
+    if args.write:
+        # Keep the sources around, the saved session refers to them
+        directory = os.path.abspath(args.write) + ".sources"
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    else:
+        directory = tempfile.mkdtemp(prefix = "melt-bench-")
+    try:
+        filenames = generate_sources(directory, args.files, args.file_lines)
+        session = list(generate_session(filenames, args.file_lines, args.marks, args.infolocs, args.blocks, args.block_lines, args.statuses, args.shuffle, args.seed))
+        if args.write:
+            with open(args.write, 'w') as f:
+                f.writelines("%(date).6f > %(line)s\n" % {'date': 0, 'line': line} for line in session)
+
+        stats = BenchStats()
+        instrument(probe, stats, args.open_tabs)
+        expected = min(args.open_tabs, args.files) * args.marks
+
+        app = probe.QApplication([sys.argv[0]])
+        (rfd, wfd) = os.pipe()
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        dispatcher = probe.MeltCommandDispatcher()
+        worker = probe.MeltWorker(dispatcher) if args.worker else None
+        comm = probe.MeltCommunication(rfd, devnull, args.read_chunk_size, False, args.batch_size, args.batch_interval / 1000.0)
+        window = probe.MeltSourceWindow(dispatcher, comm, False)
+        probe.connect_probe(comm, dispatcher, window)
+
+        data = "".join(line + "\n" for line in session)
+        timing = {}
+        def write():
+            timing['start'] = time.time()
+            view = memoryview(data)
+            while view:
+                view = view[os.write(wfd, view):]
+            os.close(wfd)
+            timing['written'] = time.time()
+        writer = threading.Thread(target = write)
+
+        def check():
+            done = comm.finished and stats.painted >= expected
+            if done or time.time() - timing['start'] > args.timeout:
+                timing['end'] = time.time()
+                timing['timed_out'] = not done
+                app.quit()
+        timer = probe.QTimer()
+        probe.QObject.connect(timer, probe.SIGNAL('timeout()'), check)
+
+        if worker:
+            worker.start()
+        comm.start()
+        writer.start()
+        timer.start(20)
+        app.exec_()
+        writer.join()
+        cpu = {'gui_s': probe.thread_cpu_time(), 'worker_s': worker.cpu_time() if worker else None}
+        if worker:
+            worker.stop()
+
+        elapsed = timing['end'] - timing['start']
+        reader = comm.reader.get_stats()
+        return {
+            'config': vars(args),
+            'lines': len(session),
+            'bytes': len(data),
+            'timed_out': timing['timed_out'],
+            'throughput': {
+                'elapsed_s': elapsed,
+                'write_s': timing['written'] - timing['start'],
+                'lines_per_s': len(session) / elapsed,
+                'marks_painted': stats.painted,
+                'marks_painted_per_s': stats.painted / elapsed,
+                'reader_bytes_per_s': reader['bytes_per_sec'],
+                'reader_lines_per_s': reader['lines_per_sec'],
+            },
+            'cpu': cpu,
+            'memory': {'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss},
+            'latency': {
+                'read_to_dispatch': percentiles(stats.read_to_dispatch),
+                'dispatch_to_paint': percentiles(stats.dispatch_to_paint),
+                'read_to_paint': percentiles(stats.read_to_paint),
+            },
+            'stages': dict((name, {'busy_s': busy, 'items': items, 'items_per_busy_s': items / busy if busy else None}) for name, (busy, items) in stats.stages.iteritems()),
+        }
+    finally:
+        if not args.write:
+            shutil.rmtree(directory, True)
+
+def main():
+    parser = argparse.ArgumentParser(description = "MELT probe benchmark")
+    parser.add_argument("--files", type=int, default=20, help="Number of SHOWFILE_PCD files")
+    parser.add_argument("--file-lines", type=int, default=5000, help="Number of lines of each generated source file")
+    parser.add_argument("--marks", type=int, default=2000, help="Number of MARKLOCATION_PCD marks per file")
+    parser.add_argument("--infolocs", type=int, default=0, help="Number of marks per file answered with an infoloc")
+    parser.add_argument("--blocks", type=int, default=4, help="Number of ADDINFOLOC_PCD blocks per infoloc")
+    parser.add_argument("--block-lines", type=int, default=10, help="Number of Gimple lines per ADDINFOLOC_PCD payload")
+    parser.add_argument("--statuses", type=int, default=1, help="Number of SETSTATUS_PCD lines")
+    parser.add_argument("--shuffle", action="store_true", help="Send the marks of a file in random order")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--open-tabs", type=int, default=sys.maxint, help="Number of tabs whose viewer is built as soon as the file is shown")
+    parser.add_argument("--read-chunk-size", type=int, default=65536, help="Reader chunk size")
+    parser.add_argument("--batch-size", type=int, default=1024, help="Dispatcher batch size")
+    parser.add_argument("--batch-interval", type=float, default=20, help="Dispatcher batch interval in ms")
+    parser.add_argument("--worker", action="store_true", help="Dispatch on a worker thread, as the probe does by default")
+    parser.add_argument("--large-file-threshold", type=int, default=4 * 1024 * 1024, help="Size above which files are loaded in the background")
+    parser.add_argument("--timeout", type=float, default=600, help="Give up after this many seconds")
+    parser.add_argument("--write", help="Also save the generated session as a recording usable with --replay (sources are kept next to it)")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = json.dumps(run(args), indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(results + "\n")
+    else:
+        sys.stdout.write(results + "\n")
+
+if __name__ == '__main__':
+    main()
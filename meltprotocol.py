@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: set ts=4 sw=4 et:
+
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+MELT probe protocol parser
+
+Each line sent by MELT is tokenized once, honouring double quoted strings
+(which may contain spaces and backslash escapes), and handed to the parser
+registered for its command, which returns a typed record.
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+from collections import namedtuple
+
+ShowFile = namedtuple('ShowFile', 'filename filenum')
+# line and col are 0-based, as used by QScintilla
+MarkLocation = namedtuple('MarkLocation', 'marknum filenum line col')
+# filenum of the infoloc records is not part of the protocol, it is filled in
+# by the dispatcher from the marknum
+StartInfoLoc = namedtuple('StartInfoLoc', 'marknum filenum')
+AddInfoLoc = namedtuple('AddInfoLoc', 'marknum filenum ident content')
+SetStatus = namedtuple('SetStatus', 'version rev')
+
+class MeltProtocolError(ValueError):
+    pass
+
+TOKEN_RE = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+ESCAPE_RE = re.compile(r'\\(.)')
+ESCAPES = {'n': '\n', 't': '\t', '"': '"', '\\': '\\'}
+
+def unescape(s):
+    if '\\' not in s:
+        return s
+    return ESCAPE_RE.sub(lambda m: ESCAPES.get(m.group(1), m.group(0)), s)
+
+def quote(s):
+    """Inverse of unescape, as a quoted token."""
+    return '"' + s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\t', '\\t') + '"'
+
+def tokenize(line):
+    """Split a protocol line on blanks, a quoted string being a single token."""
+    if '"' not in line:
+        return line.split()
+    tokens = []
+    for m in TOKEN_RE.finditer(line):
+        quoted = m.group(1)
+        if quoted is None:
+            tokens.append(m.group(2))
+        else:
+            tokens.append(unescape(quoted))
+    return tokens
+
+COMMAND_PARSERS = {}
+
+def command_parser(command):
+    def register(func):
+        COMMAND_PARSERS[command] = func
+        return func
+    return register
+
+def parse_line(line):
+    """
+    Parse one line of the MELT protocol. Returns None for commands without a
+    registered parser and raises MeltProtocolError on malformed commands.
+    """
+    tokens = tokenize(line)
+    if not tokens:
+        return None
+    parser = COMMAND_PARSERS.get(tokens[0])
+    if parser is None:
+        return None
+    try:
+        return parser(tokens)
+    except (IndexError, ValueError) as e:
+        raise MeltProtocolError("Malformed %(command)s: %(error)s" % {'command': tokens[0], 'error': e})
+
+def is_pseudo_file(filename):
+    return filename.startswith("<") and filename.endswith(">")
+
+@command_parser("SHOWFILE_PCD")
+def parse_showfile(tokens):
+    # SHOWFILE_PCD "drivers/media/rc/imon.c" 1
+    filename = tokens[1]
+    if not is_pseudo_file(filename):
+        filename = os.path.abspath(filename)
+    return ShowFile(filename, int(tokens[2]))
+
+@command_parser("MARKLOCATION_PCD")
+def parse_marklocation(tokens):
+    # MARKLOCATION_PCD 543 1 1247 10
+    # -1 pour corriger l'affichage
+    return MarkLocation(int(tokens[1]), int(tokens[2]), max(int(tokens[3]) - 1, 0), max(int(tokens[4]) - 1, 0))
+
+@command_parser("STARTINFOLOC_PCD")
+def parse_startinfoloc(tokens):
+    # STARTINFOLOC_PCD 543
+    return StartInfoLoc(int(tokens[1]), None)
+
+@command_parser("ADDINFOLOC_PCD")
+def parse_addinfoloc(tokens):
+    # ADDINFOLOC_PCD 543 "1:Basic Block #10 Gimple Seq" "[imon.c : 1247:10] rel_x = (char) D.21223;\n"
+    return AddInfoLoc(int(tokens[1]), None, tokens[2], tokens[3] if len(tokens) > 3 else "")
+
+@command_parser("SETSTATUS_PCD")
+def parse_setstatus(tokens):
+    # SETSTATUS_PCD "MELT version=0.9.6-d [melt-branch_revision_190124]"
+    version = ""
+    rev = ""
+    for word in " ".join(tokens[1:]).split():
+        if word.startswith("version="):
+            version = word.split("=", 1)[1]
+        elif word.startswith("[") and word.endswith("]"):
+            rev = word[1:-1]
+    return SetStatus(version, rev)
+
+SAMPLE_COMMANDS = {
+    'SHOWFILE_PCD': 'SHOWFILE_PCD  "drivers/media/rc/imon.c"  1',
+    'MARKLOCATION_PCD': 'MARKLOCATION_PCD 543 1 1247 10',
+    'STARTINFOLOC_PCD': 'STARTINFOLOC_PCD 543',
+    'ADDINFOLOC_PCD': 'ADDINFOLOC_PCD 543  "1:Basic Block #10 Gimple Seq"   "[drivers/media/rc/imon.c : 1247:10] rel_x.11 = (signed char) rel_x;\\n[drivers/media/rc/imon.c : 1247:10] D.21223 = rel_x.11 | -16;\\n[drivers/media/rc/imon.c : 1247:10] rel_x = (char) D.21223;\\n"  ',
+    'SETSTATUS_PCD': 'SETSTATUS_PCD  "MELT version=0.9.6-d [melt-branch_revision_190124]"  ',
+}
+
+def benchmark(iterations):
+    """Return the parse cost in microseconds per command, for each command type."""
+    results = {}
+    for command, line in sorted(SAMPLE_COMMANDS.items()):
+        start = time.time()
+        for i in xrange(iterations):
+            parse_line(line)
+        results[command] = (time.time() - start) * 1e6 / iterations
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MELT protocol parser micro-benchmark")
+    parser.add_argument("-n", type=int, default=100000, help="Number of parses per command type")
+    args = parser.parse_args()
+    for command, cost in sorted(benchmark(args.n).items()):
+        sys.stdout.write("%(command)-20s %(cost)8.3f us/command\n" % {'command': command, 'cost': cost})
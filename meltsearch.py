@@ -0,0 +1,262 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: set ts=4 sw=4 et:
+
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+MELT probe search indexes
+
+The source files shown by MELT are indexed by trigram: each file is broken
+into the three byte sequences of its lower-cased content, and the index
+maps a trigram to the files holding it. A query is only matched against
+the files holding every trigram of the query, so that searching many files
+does not mean scanning all of them.
+
+The infoloc payloads are indexed by token (identifiers and Gimple
+temporaries), so that the marks whose blocks mention a variable can be
+found without opening them one by one.
+"""
+
+import re
+import sys
+import time
+import array
+import argparse
+from collections import namedtuple, OrderedDict
+
+# line and col are 0-based, as used by QScintilla
+SearchMatch = namedtuple('SearchMatch', 'filenum line col text')
+
+class MeltSearchIndex(object):
+    """
+    Case-insensitive substring search across files. Candidate files are
+    matched against the content read when they were indexed, kept in a cache
+    of at most cache_size bytes: the least recently searched files are
+    dropped from it and read again when a query needs them. Queries shorter
+    than a trigram match every file. The index is not thread-safe: files are
+    added and queries run from the same thread.
+    """
+    # Longest line text returned with a match
+    TEXT_WIDTH = 200
+    CACHE_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, cache_size = CACHE_SIZE):
+        # doc -> (filenum, filename); docs are numbered in the order files are added
+        self.files = []
+        self.docs = {}
+        # trigram -> docs holding it, in increasing order
+        self.postings = {}
+        self.bytes = 0
+        # doc -> content, least recently used first
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cached = 0
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, filenum):
+        return filenum in self.docs
+
+    def add_file(self, filenum, filename, content):
+        """Index the content of a file, returns False if it was already indexed or is binary."""
+        if filenum in self.docs or '\0' in content[:8192]:
+            return False
+        doc = len(self.files)
+        self.files.append((filenum, filename))
+        self.docs[filenum] = doc
+        self.bytes += len(content)
+        self.cache_content(doc, content)
+        lower = content.lower()
+        # A generator rather than one C call, so that indexing a large file
+        # from a background thread does not hold the interpreter meanwhile
+        trigrams = set(lower[i:i + 3] for i in xrange(len(lower) - 2))
+        postings = self.postings
+        for trigram in trigrams:
+            try:
+                postings[trigram].append(doc)
+            except KeyError as e:
+                postings[trigram] = array.array('i', [doc])
+        return True
+
+    def candidates(self, query):
+        """Docs which may hold query (lower-cased), in increasing order."""
+        if len(query) < 3:
+            return xrange(len(self.files))
+        lists = sorted((self.postings.get(query[i:i + 3], ()) for i in xrange(len(query) - 2)), key = len)
+        docs = set(lists[0])
+        for docs_of in lists[1:]:
+            if not docs:
+                break
+            docs.intersection_update(docs_of)
+        return sorted(docs)
+
+    def cache_content(self, doc, content):
+        self.cache[doc] = content
+        self.cached += len(content)
+        while self.cached > self.cache_size and len(self.cache) > 1:
+            (old, dropped) = self.cache.popitem(last = False)
+            self.cached -= len(dropped)
+
+    def content_of(self, doc):
+        """Content of a doc, None if it can no longer be read."""
+        try:
+            content = self.cache.pop(doc)
+        except KeyError as e:
+            try:
+                with open(self.files[doc][1], 'rb') as f:
+                    content = f.read()
+            except IOError as e:
+                return None
+            self.cache_content(doc, content)
+            return content
+        self.cache[doc] = content
+        return content
+
+    def search(self, query, limit = 1000):
+        """
+        Matches of query, by file in the order they were added, then by
+        position. Returns (matches, truncated), truncated telling whether
+        more than limit matches were found.
+        """
+        matches = []
+        if not query:
+            return (matches, False)
+        pattern = re.compile(re.escape(query), re.I)
+        for doc in self.candidates(query.lower()):
+            filenum = self.files[doc][0]
+            content = self.content_of(doc)
+            if content is None:
+                # Gone since it was indexed: nothing to match
+                continue
+            # Lines are counted from one match to the next
+            (line, pos) = (0, 0)
+            for m in pattern.finditer(content):
+                if len(matches) >= limit:
+                    return (matches, True)
+                line += content.count("\n", pos, m.start())
+                pos = m.start()
+                begin = content.rfind("\n", 0, pos) + 1
+                end = content.find("\n", begin, begin + self.TEXT_WIDTH)
+                matches.append(SearchMatch(filenum, line, pos - begin, content[begin:end if end >= 0 else begin + self.TEXT_WIDTH]))
+        return (matches, False)
+
+    def nbytes(self):
+        """Rough size of the postings, the cached contents not included."""
+        return sum(len(docs) * docs.itemsize for docs in self.postings.itervalues()) + len(self.postings) * 64
+
+class MeltInfoLocIndex(object):
+    """
+    Inverted index from the tokens of the ADDINFOLOC payloads to the marks
+    they were sent for, updated as payloads arrive. Memory is bounded by
+    budget postings (a token in a mark): past it, the marks indexed first
+    are dropped, a quarter of the budget at a time. The index is not
+    thread-safe.
+    """
+    # Identifiers, including Gimple temporaries such as D.21223 or rel_x.11
+    TOKEN_RE = re.compile(r"[A-Za-z_][\w.]*\w|[A-Za-z_]")
+
+    def __init__(self, budget):
+        self.budget = max(budget, 1)
+        # token -> marks holding it, in the order they were indexed
+        self.postings = {}
+        # marknum -> [filenum, idents indexed, postings], oldest first
+        self.marks = OrderedDict()
+        self.entries = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.marks)
+
+    def tokens(self, text):
+        tokens = set(self.TOKEN_RE.findall(text))
+        # rel_x.11 is also found as rel_x
+        tokens.update([token.split(".", 1)[0] for token in tokens if "." in token])
+        return tokens
+
+    def add(self, marknum, filenum, ident, content):
+        """Index an infoloc block, returns False if that block of the mark was already indexed."""
+        try:
+            mark = self.marks[marknum]
+        except KeyError as e:
+            mark = self.marks[marknum] = [filenum, set(), 0]
+        if ident in mark[1]:
+            return False
+        mark[1].add(ident)
+        postings = self.postings
+        added = 0
+        for token in self.tokens(ident + "\n" + content):
+            try:
+                docs = postings[token]
+            except KeyError as e:
+                postings[token] = array.array('i', [marknum])
+                added += 1
+                continue
+            # Blocks of a mark arrive together: the mark is last if already there
+            if docs[-1] != marknum:
+                docs.append(marknum)
+                added += 1
+        mark[2] += added
+        self.entries += added
+        if self.entries > self.budget:
+            self.evict()
+        return True
+
+    def evict(self):
+        target = self.budget * 3 / 4
+        dropped = set()
+        while self.marks and self.entries > target:
+            (marknum, (filenum, idents, entries)) = self.marks.popitem(last = False)
+            dropped.add(marknum)
+            self.entries -= entries
+        self.evicted += len(dropped)
+        for token in self.postings.keys():
+            docs = array.array('i', [marknum for marknum in self.postings[token] if marknum not in dropped])
+            if docs:
+                self.postings[token] = docs
+            else:
+                del self.postings[token]
+
+    def query(self, text):
+        """(marknum, filenum) of the marks holding every token of text, None if text has no token."""
+        tokens = self.TOKEN_RE.findall(text)
+        if not tokens:
+            return None
+        lists = sorted((self.postings.get(token, ()) for token in tokens), key = len)
+        marknums = set(lists[0])
+        for docs in lists[1:]:
+            if not marknums:
+                break
+            marknums.intersection_update(docs)
+        return [(marknum, self.marks[marknum][0]) for marknum in marknums if marknum in self.marks]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MELT source search index micro-benchmark")
+    parser.add_argument("query", help="Text to look for")
+    parser.add_argument("files", nargs="+", help="Files to index")
+    args = parser.parse_args()
+    index = MeltSearchIndex()
+    start = time.time()
+    for filenum, filename in enumerate(args.files):
+        with open(filename, 'rb') as f:
+            index.add_file(filenum, filename, f.read())
+    indexed = time.time()
+    (matches, truncated) = index.search(args.query)
+    searched = time.time()
+    for match in matches:
+        sys.stdout.write("%(file)s:%(line)d:%(col)d: %(text)s\n" % {'file': args.files[match.filenum], 'line': match.line + 1, 'col': match.col + 1, 'text': match.text})
+    sys.stderr.write("Indexed %(files)d files (%(bytes)d bytes, %(trigrams)d trigrams) in %(index).3fs, %(count)d matches%(more)s in %(search).3fs\n" % {
+        'files': len(index), 'bytes': index.bytes, 'trigrams': len(index.postings), 'index': indexed - start,
+        'count': len(matches), 'more': "+" if truncated else "", 'search': searched - indexed})
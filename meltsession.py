@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: set ts=4 sw=4 et:
+
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+MELT probe session store
+
+What MELT reported during a session (files, marks, infoloc payloads and the
+MELT version) is kept in a SQLite database, filled incrementally while the
+probe runs. Marks are indexed by (filenum, line) so that a past session can
+be reopened and browsed a range of lines at a time, without loading every
+mark in memory.
+"""
+
+import sqlite3
+
+import meltprotocol
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    filenum INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS marks (
+    marknum INTEGER PRIMARY KEY,
+    filenum INTEGER NOT NULL,
+    line INTEGER NOT NULL,
+    col INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS marks_filenum_line ON marks (filenum, line);
+CREATE TABLE IF NOT EXISTS infolocs (
+    marknum INTEGER NOT NULL,
+    ident TEXT NOT NULL,
+    content TEXT NOT NULL,
+    UNIQUE (marknum, ident)
+);
+CREATE TABLE IF NOT EXISTS status (
+    version TEXT,
+    rev TEXT
+);
+"""
+
+class MeltSessionStore(object):
+    """
+    SQLite database of one MELT session. The connection must only be used
+    from the thread that opened the store. Writes are only made durable by
+    commit(), which callers are expected to call periodically. A store
+    opened to record a session starts empty, so that runs are not merged.
+    """
+    TABLES = ('files', 'marks', 'infolocs', 'status')
+
+    def __init__(self, filename, truncate = False):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.text_factory = str
+        # The store is a cache of what MELT said: losing the tail of a
+        # session on a crash is fine, stalling the probe on fsync is not
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.executescript(SCHEMA)
+        if truncate:
+            for table in self.TABLES:
+                self.db.execute("DELETE FROM %(table)s" % {'table': table})
+            self.db.commit()
+
+    def add_file(self, obj):
+        self.db.execute("INSERT OR REPLACE INTO files (filenum, filename) VALUES (?, ?)", (obj.filenum, obj.filename))
+
+    def add_marks(self, marks):
+        self.db.executemany("INSERT OR REPLACE INTO marks (marknum, filenum, line, col) VALUES (?, ?, ?, ?)",
+            ((o.marknum, o.filenum, o.line, o.col) for o in marks))
+
+    def add_infoloc(self, obj):
+        self.db.execute("INSERT OR REPLACE INTO infolocs (marknum, ident, content) VALUES (?, ?, ?)", (obj.marknum, obj.ident, obj.content))
+
+    def set_status(self, obj):
+        self.db.execute("DELETE FROM status")
+        self.db.execute("INSERT INTO status (version, rev) VALUES (?, ?)", (obj.version, obj.rev))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def files(self):
+        return [meltprotocol.ShowFile(filename, filenum) for (filenum, filename) in
+            self.db.execute("SELECT filenum, filename FROM files ORDER BY filenum")]
+
+    def status(self):
+        row = self.db.execute("SELECT version, rev FROM status").fetchone()
+        if row is None:
+            return None
+        return meltprotocol.SetStatus(*row)
+
+    def count_marks(self, filenum):
+        return self.db.execute("SELECT COUNT(*) FROM marks WHERE filenum = ?", (filenum,)).fetchone()[0]
+
+    def marks_in_lines(self, filenum, first, last):
+        """Marks of a file on lines first to last, both included."""
+        return [meltprotocol.MarkLocation(marknum, filenum, line, col) for (marknum, line, col) in
+            self.db.execute("SELECT marknum, line, col FROM marks WHERE filenum = ? AND line BETWEEN ? AND ? ORDER BY line, col",
+                (filenum, first, last))]
+
+    def mark(self, marknum):
+        row = self.db.execute("SELECT marknum, filenum, line, col FROM marks WHERE marknum = ?", (marknum,)).fetchone()
+        if row is None:
+            return None
+        return meltprotocol.MarkLocation(*row)
+
+    def infolocs(self, marknum):
+        return [meltprotocol.AddInfoLoc(marknum, None, ident, content) for (ident, content) in
+            self.db.execute("SELECT ident, content FROM infolocs WHERE marknum = ? ORDER BY rowid", (marknum,))]
@@ -21,23 +21,38 @@ MELT probe in PyQt
 
 import sys
 import os
+import io
+import errno
+import fcntl
+import time
 import argparse
 import select
 import pprint
 import re
 import logging
+import bisect
+import mmap
+import array
+import collections
+import json
+import signal
+import socket
+import tempfile
 from datetime import datetime
-from threading import Thread
+from threading import Lock
+import meltprotocol
+import meltsession
+import meltsearch
 from PyQt4.QtGui import *
 from PyQt4.QtCore import *
 from PyQt4.Qsci import *
 
 MELT_SIGNAL_UNHANDLED_COMMAND = SIGNAL("unhandledCommand(PyQt_PyObject)")
-MELT_SIGNAL_DISPATCH_COMMAND = SIGNAL("dispatchCommand(PyQt_PyObject)")
-MELT_SIGNAL_APPEND_TRACE_COMMAND = SIGNAL("appendCommand(PyQt_PyObject)")
+MELT_SIGNAL_DISPATCH_BATCH = SIGNAL("dispatchBatch(PyQt_PyObject)")
+MELT_SIGNAL_APPEND_TRACE_COMMANDS = SIGNAL("appendCommands(PyQt_PyObject)")
 MELT_SIGNAL_APPEND_TRACE_REQUEST = SIGNAL("appendRequest(PyQt_PyObject)")
 MELT_SIGNAL_SOURCE_SHOWFILE = SIGNAL("sourceShowfile(PyQt_PyObject)")
-MELT_SIGNAL_SOURCE_MARKLOCATION = SIGNAL("sourceMarklocation(PyQt_PyObject)")
+MELT_SIGNAL_SOURCE_MARKLOCATIONS = SIGNAL("sourceMarklocations(PyQt_PyObject)")
 MELT_SIGNAL_SOURCE_INFOLOCATION = SIGNAL("sourceInfoLocation(PyQt_PyObject)")
 MELT_SIGNAL_ASK_INFOLOCATION = SIGNAL("askInfoLocation(PyQt_PyObject)")
 MELT_SIGNAL_MOVE_TO_INDICATOR = SIGNAL("moveToIndicator(PyQt_PyObject)")
@@ -46,6 +61,7 @@ MELT_SIGNAL_SOURCE_STARTINFOLOC = SIGNAL("startInfoLocation(PyQt_PyObject)")
 MELT_SIGNAL_SOURCE_ADDINFOLOC = SIGNAL("addInfoLocation(PyQt_PyObject)")
 
 MELT_SIGNAL_SHOWFILE_COMPLETE = SIGNAL("showfileComplete(PyQt_PyObject)")
+MELT_SIGNAL_SHOWFILE_FAILED = SIGNAL("showfileFailed(PyQt_PyObject)")
 
 MELT_SIGNAL_INFOLOC_COMPLETE = SIGNAL("infolocComplete(PyQt_PyObject)")
 
@@ -56,15 +72,232 @@ MELT_SIGNAL_UPDATECURRENT = SIGNAL("updateCurrent(PyQt_PyObject)")
 
 MELT_SIGNAL_GETVERSION = SIGNAL("getVersion(PyQt_PyObject)")
 
+MELT_SIGNAL_REPLAY_DONE = SIGNAL("replayDone()")
+
+MELT_SIGNAL_MELT_EXITED = SIGNAL("meltExited()")
+
+MELT_SIGNAL_VISIBLE_LINES = SIGNAL("visibleLines(PyQt_PyObject)")
+
+MELT_SIGNAL_CURSOR_MOVED = SIGNAL("cursorMoved(PyQt_PyObject)")
+
+MELT_SIGNAL_INDEX_FILE = SIGNAL("indexFile(PyQt_PyObject)")
+MELT_SIGNAL_SEARCH = SIGNAL("search(PyQt_PyObject)")
+MELT_SIGNAL_SEARCH_RESULTS = SIGNAL("searchResults(PyQt_PyObject)")
+
+MELT_SIGNAL_INFOLOC_QUERY = SIGNAL("infolocQuery(PyQt_PyObject)")
+MELT_SIGNAL_INFOLOC_MATCHES = SIGNAL("infolocMatches(PyQt_PyObject)")
+
 logger = logging.getLogger('melt-probe')
 console = logging.StreamHandler()
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 console.setFormatter(formatter)
 logger.addHandler(console)
 
-class MeltInfoLoc(QMainWindow):
-    INFOLOC_IDENT_RE = re.compile(r"(\d+):(.*)")
+class MeltHistogram(object):
+    """Latency histogram with power of two buckets, in microseconds."""
+    BUCKETS = 32
 
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        us = int(seconds * 1e6)
+        self.buckets[min(us.bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th percentile
+        rank = self.count * p
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return (1 << i) / 1e6
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'mean_ms': self.total * 1000 / self.count if self.count else 0,
+                'p50_ms': self.percentile(0.5) * 1000, 'p99_ms': self.percentile(0.99) * 1000, 'max_ms': self.max * 1000,
+                'buckets_us': dict(("<%d" % (1 << i), n) for i, n in enumerate(self.buckets) if n)}
+
+class MeltMetrics(object):
+    """
+    Counters, latency histograms and gauges of the probe. The instance lives
+    in METRICS when metrics are enabled; instrumented code checks METRICS
+    against None first, so that they cost next to nothing when disabled.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        # name -> (callable, maximum seen)
+        self.gauges = {}
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            try:
+                histogram = self.histograms[name]
+            except KeyError as e:
+                histogram = self.histograms[name] = MeltHistogram()
+            histogram.observe(seconds)
+
+    def add_gauge(self, name, func):
+        self.gauges[name] = [func, 0]
+
+    def sample_gauges(self):
+        for gauge in self.gauges.itervalues():
+            gauge[1] = max(gauge[1], gauge[0]())
+
+    def snapshot(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        with self.lock:
+            return {
+                'elapsed_s': elapsed,
+                'counters': dict((name, {'count': n, 'rate': n / elapsed}) for name, n in self.counters.iteritems()),
+                'histograms': dict((name, h.snapshot()) for name, h in self.histograms.iteritems()),
+                'gauges': dict((name, {'value': func(), 'max': peak}) for name, (func, peak) in self.gauges.iteritems()),
+            }
+
+    def dump(self, filename = None):
+        data = json.dumps(self.snapshot(), indent = 2, sort_keys = True)
+        if filename:
+            with open(filename, 'w') as f:
+                f.write(data + "\n")
+        else:
+            sys.stderr.write(data + "\n")
+
+METRICS = None
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+def thread_cpu_time(task = "thread-self"):
+    """CPU time in seconds (user and system) of a thread, 0 when /proc does not tell."""
+    try:
+        with open("/proc/%(task)s/stat" % {'task': task}) as f:
+            # The command name may hold blanks, the fields start after it
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+    except (IOError, IndexError, ValueError) as e:
+        return 0.0
+
+# ADDINFOLOC as handed to the infoloc windows: the ident split into block
+# number (None when it has none) and title; the content stays raw
+PreparedInfoLoc = collections.namedtuple('PreparedInfoLoc', meltprotocol.AddInfoLoc._fields + ('id', 'title'))
+
+class MeltInfoLocBlock(object):
+    __slots__ = ('row', 'id', 'title', 'payload', 'lines')
+
+    def __init__(self, row, id, title, payload):
+        self.row = row
+        self.id = id
+        self.title = title
+        # Raw payload, only split into lines when the block is first expanded
+        self.payload = payload
+        self.lines = None
+
+class MeltInfoLocModel(QAbstractItemModel):
+    """
+    Infoloc blocks of a mark. Top level rows are the blocks, their children
+    the lines of the Gimple payload; those child rows are only created when
+    a block is first expanded (canFetchMore/fetchMore) and are kept across
+    collapse/expand.
+    """
+    HEADERS = ["ID", "Block", "Content"]
+
+    def __init__(self, parent = None):
+        QAbstractItemModel.__init__(self, parent)
+        self.blocks = []
+
+    def add_block(self, id, title, payload):
+        row = len(self.blocks)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.blocks.append(MeltInfoLocBlock(row, id, title, payload))
+        self.endInsertRows()
+
+    def block_of(self, parent):
+        # Block whose children are indexed under parent, None for the root
+        if parent.isValid() and parent.internalPointer() is None:
+            return self.blocks[parent.row()]
+        return None
+
+    def index(self, row, column, parent = QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column)
+        return self.createIndex(row, column, self.blocks[parent.row()])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        block = index.internalPointer()
+        if block is None:
+            return QModelIndex()
+        return self.createIndex(block.row, 0)
+
+    def rowCount(self, parent = QModelIndex()):
+        if not parent.isValid():
+            return len(self.blocks)
+        block = self.block_of(parent)
+        if block is None or block.lines is None:
+            return 0
+        return len(block.lines)
+
+    def columnCount(self, parent = QModelIndex()):
+        return len(self.HEADERS)
+
+    def hasChildren(self, parent = QModelIndex()):
+        if not parent.isValid():
+            return len(self.blocks) > 0
+        return self.block_of(parent) is not None
+
+    def canFetchMore(self, parent):
+        block = self.block_of(parent)
+        return block is not None and block.lines is None
+
+    def fetchMore(self, parent):
+        block = self.block_of(parent)
+        if block is None or block.lines is not None:
+            return
+        lines = block.payload.rstrip("\n").split("\n")
+        self.beginInsertRows(parent, 0, len(lines) - 1)
+        block.lines = lines
+        block.payload = None
+        self.endInsertRows()
+
+    def data(self, index, role = Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return QVariant()
+        block = index.internalPointer()
+        if block is None:
+            block = self.blocks[index.row()]
+            if index.column() == 0:
+                return QVariant(block.id)
+            elif index.column() == 1:
+                return QVariant(block.title)
+            return QVariant()
+        if index.column() == 2:
+            return QVariant(block.lines[index.row()])
+        return QVariant()
+
+    def headerData(self, section, orientation, role = Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return QVariant(self.HEADERS[section])
+        return QVariant()
+
+class MeltInfoLoc(QMainWindow):
     def __init__(self):
         QMainWindow.__init__(self)
         self.handled_marknums = {}
@@ -73,14 +306,15 @@ class MeltInfoLoc(QMainWindow):
     def initUI(self):
         window = QWidget()
         self.vlayout = QVBoxLayout()
-        self.tree = QTreeWidget()
-        # {'marknum': 543, 'command': 'addinfoloc', 'filenum': 1, 'payload': [' "1:Basic Block #10 Gimple Seq', '[drivers/media/rc/imon.c : 1247:10] rel_x.11 = (signed char) rel_x;\\n[drivers/media/rc/imon.c : 1247:10] D.21223 = rel_x.11 | -16;\\n[drivers/media/rc/imon.c : 1247:10] rel_x = (char) D.21223;\\n"  ']}
+        # AddInfoLoc(marknum=543, filenum=1, ident='1:Basic Block #10 Gimple Seq', content='[drivers/media/rc/imon.c : 1247:10] rel_x.11 = (signed char) rel_x;\n[drivers/media/rc/imon.c : 1247:10] D.21223 = rel_x.11 | -16;\n[drivers/media/rc/imon.c : 1247:10] rel_x = (char) D.21223;\n')
         # columns:
         #  - "1" -> infolocid
         #  - "Basic Block #10 Gimple Seq" -> bb
         #  - ... -> content
-        self.tree.setColumnCount(3)
-        self.tree.setHeaderLabels(["ID", "Block", "Content"])
+        self.model = MeltInfoLocModel(self)
+        self.tree = QTreeView()
+        self.tree.setUniformRowHeights(True)
+        self.tree.setModel(self.model)
         self.vlayout.addWidget(self.tree)
         window.setLayout(self.vlayout)
         window.show()
@@ -91,31 +325,16 @@ class MeltInfoLoc(QMainWindow):
 
     def push_infolocation(self, obj):
         logger.debug("push_infolocation(%(obj)s)" % {'obj': obj})
-        ident = obj['payload'][0].replace('"', '')
-        payload = obj['payload'][1].replace('"', '').split("\\n")
 
-        getident = self.INFOLOC_IDENT_RE.search(ident)
-        if getident:
-            id = getident.group(1)
-            marknum_key = str(obj['marknum']) + ":" + str(id)
+        # Ident parsed by the dispatcher, see MeltCommandDispatcher.prepare_infoloc
+        if obj.id is not None:
+            marknum_key = str(obj.marknum) + ":" + str(obj.id)
             logger.debug("Checking for previously handled %(marknum_key)s ..." % {'marknum_key': marknum_key})
             if self.handled_marknums.has_key(marknum_key):
                 logger.debug("Already handled %(marknum_key)s not duplicating." % {'marknum_key': marknum_key})
                 return
 
-            block = getident.group(2)
-            cols = QStringList()
-            cols.append(id)
-            cols.append(block)
-            item = QTreeWidgetItem(cols, QTreeWidgetItem.UserType)
-            for line in payload:
-                chcols = QStringList()
-                chcols.append("")
-                chcols.append("")
-                chcols.append(line)
-                child = QTreeWidgetItem(item, chcols, QTreeWidgetItem.UserType)
-                item.addChild(child)
-            self.tree.addTopLevelItem(item)
+            self.model.add_block(obj.id, obj.title, obj.content)
             self.handled_marknums[marknum_key] = True
 
     def closeEvent(self, ev):
@@ -124,20 +343,29 @@ class MeltInfoLoc(QMainWindow):
 class MeltSourceViewer(QsciScintilla):
     ARROW_MARKER_PENDING = 8
     ARROW_MARKER_SELECTED = 9
+    # Columns covered by the indicator of a mark
+    INDICATOR_WIDTH = 2
+    # Files bigger than this are memory-mapped and streamed into the editor
+    LARGE_FILE_THRESHOLD = 4 * 1024 * 1024
+    LOAD_CHUNK_SIZE = 512 * 1024
 
     def __init__(self, parent, obj):
         QsciScintilla.__init__(self, parent)
 
         self.infolocs = {}
         self.mil_to_marknum = {}
-        self.indicators = {}
-        self.marklocations = {}
-        self.markers_counter = {}
+        self.store = MeltCommandDispatcher.STORE
         self.file = obj
+        # Marks of the file, by position, shared with the window
+        self.indicators = MeltCommandDispatcher.ROUTES[obj.filenum].marks
+        self.markers_counter = {}
         self.setReadOnly(True)
-        self.setObjectName("MeltSourceViewer:" + self.file['filename'])
+        self.setObjectName("MeltSourceViewer:" + self.file.filename)
         self.indicatorPending = self.indicatorDefine(QsciScintilla.BoxIndicator)
         self.indicatorSelected = self.indicatorDefine(QsciScintilla.DotBoxIndicator)
+        # Marks matching the infoloc query
+        self.indicatorMatch = self.indicatorDefine(QsciScintilla.RoundBoxIndicator)
+        self.setIndicatorForegroundColor(QColor("#ff9900"), self.indicatorMatch)
 
         # Set the default font
         font = QFont()
@@ -171,6 +399,12 @@ class MeltSourceViewer(QsciScintilla):
         self.connect(self,
             SIGNAL('indicatorClicked(int, int, Qt::KeyboardModifiers)'),
             self.on_indicator_clicked)
+        self.connect(self.verticalScrollBar(),
+            SIGNAL('valueChanged(int)'),
+            self.slot_scrolled)
+        self.connect(self,
+            SIGNAL('cursorPositionChanged(int, int)'),
+            self.slot_cursorMoved)
 
         # Brace matching: enable for a brace immediately before or after
         # the current position
@@ -186,7 +420,7 @@ class MeltSourceViewer(QsciScintilla):
         # courier.
         #
         ## lexer.setDefaultFont(font)
-        self.setLexer(self.select_lexer(self.file['filename']))
+        self.setLexer(self.select_lexer(self.file.filename))
         ## self.SendScintilla(QsciScintilla.SCI_STYLESETFONT, 1, 'Courier')
 
         # Don't want to see the horizontal scrollbar at all
@@ -197,10 +431,21 @@ class MeltSourceViewer(QsciScintilla):
         # not too small
         self.setMinimumSize(600, 450)
 
-        self.append(self.read_file(self.file['filename']))
+        self.load_file(self.file.filename)
 
     def get_filenum(self):
-        return self.file['filenum']
+        return self.file.filenum
+
+    def visible_lines(self):
+        first = self.firstVisibleLine()
+        return (first, first + self.SendScintilla(QsciScintilla.SCI_LINESONSCREEN))
+
+    def slot_scrolled(self, value = None):
+        (first, last) = self.visible_lines()
+        self.emit(MELT_SIGNAL_VISIBLE_LINES, (self.file.filenum, first, last))
+
+    def slot_cursorMoved(self, line, index):
+        self.emit(MELT_SIGNAL_CURSOR_MOVED, (self.file.filenum, line))
 
     def select_lexer(self, filename):
         lexer = QsciLexerBash()
@@ -212,7 +457,7 @@ class MeltSourceViewer(QsciScintilla):
         return lexer
 
     def read_file(self, filename):
-        if (filename.startswith("<") and filename.endswith(">")):
+        if meltprotocol.is_pseudo_file(filename):
             return "Pseudo file, built-in."
 
         content = ""
@@ -220,19 +465,71 @@ class MeltSourceViewer(QsciScintilla):
             content = f.readlines()
         return "".join(content)
 
-    def marknum_to_lineindex(self, marknum):
-        if not self.marklocations.has_key(marknum):
-            return None
+    def load_file(self, filename):
+        self.loaded = True
+        # Rows of the marks put aside until their lines are loaded
+        self.pending_marks = array.array('i')
+        # Search match to show once its line is loaded
+        self.pending_match = None
+        if meltprotocol.is_pseudo_file(filename) or os.path.getsize(filename) < self.LARGE_FILE_THRESHOLD:
+            self.append(self.read_file(filename))
+            return
+
+        # Large file: map it and append it chunk by chunk from the event loop,
+        # so that the file can be looked at while the rest is loading
+        with open(filename, 'rb') as f:
+            self.mapping = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        self.loaded = False
+        self.load_offset = 0
+        self.load_timer = QTimer(self)
+        self.connect(self.load_timer, SIGNAL('timeout()'), self.load_chunk)
+        self.load_timer.start(0)
+        logger.debug("Loading %(file)s (%(size)d bytes) in background" % {'file': filename, 'size': len(self.mapping)})
+
+    def load_chunk(self):
+        size = len(self.mapping)
+        end = self.load_offset + self.LOAD_CHUNK_SIZE
+        if end < size:
+            # Only append whole lines
+            nl = self.mapping.find('\n', end)
+            end = size if nl < 0 else nl + 1
         else:
-            return self.marklocations[marknum]
+            end = size
+        self.append(self.mapping[self.load_offset:end])
+        self.load_offset = end
+
+        if end >= size:
+            self.load_timer.stop()
+            self.mapping.close()
+            self.mapping = None
+            self.loaded = True
+            logger.debug("Loaded %(file)s, replaying %(count)d marks" % {'file': self.file.filename, 'count': len(self.pending_marks)})
+            pending = self.pending_marks
+            self.pending_marks = array.array('i')
+            self.mark_locations(self.store.view(pending))
+            if self.pending_match is not None:
+                self.show_match(*self.pending_match)
+
+    def show_match(self, line, col, length):
+        if not self.loaded and line >= self.lines() - 1:
+            self.pending_match = (line, col, length)
+            return
+        self.pending_match = None
+        self.setSelection(line, col, line, col + length)
+        self.ensureLineVisible(line)
+        self.setFocus()
 
-    def lineindex_to_marknum(self, line, index):
-        key = str(line) + ":" + str(index)
-        key2 = str(line) + ":" + str(index + 1)
-        if not self.indicators.has_key(key) and not self.indicators.has_key(key2):
+    def marknum_to_lineindex(self, marknum):
+        row = self.store.row_of(marknum)
+        if row < 0 or self.store.state[row] == MeltMarkStore.STATE_NONE:
             return None
-        else:
-            return self.marklocations[self.indicators[key]['marknum']]
+        return (self.store.line[row], self.store.col[row])
+
+    def lineindex_to_marknums(self, line, index):
+        # Only the painted ones: marks of lines still loading are indexed too
+        store = self.store
+        return [marknum for marknum in self.indicators.covering(line, index, self.INDICATOR_WIDTH)
+            if store.state[store.row_of(marknum)] != MeltMarkStore.STATE_NONE]
 
     def set_marker(self, line, stateFrom, stateTo):
         self.markerDelete(line, stateFrom)
@@ -261,31 +558,61 @@ class MeltSourceViewer(QsciScintilla):
     def switch_marklocation_pending(self, marknum, init = False):
         pos = self.marknum_to_lineindex(marknum)
         if pos is not None:
-            line = pos['line']
-            index = pos['index']
-            self.clearIndicatorRange(line, index, line, index + 2, self.indicatorSelected)
-            self.fillIndicatorRange(line, index, line, index + 2, self.indicatorPending)
+            (line, index) = pos
+            self.store.state[self.store.row_of(marknum)] = MeltMarkStore.STATE_PENDING
+            self.clearIndicatorRange(line, index, line, index + self.INDICATOR_WIDTH, self.indicatorSelected)
+            self.fillIndicatorRange(line, index, line, index + self.INDICATOR_WIDTH, self.indicatorPending)
             self.set_marker_pending(line, init)
 
     def switch_marklocation_selected(self, marknum):
         pos = self.marknum_to_lineindex(marknum)
         if pos is not None:
-            line = pos['line']
-            index = pos['index']
-            self.clearIndicatorRange(line, index, line, index + 2, self.indicatorPending)
-            self.fillIndicatorRange(line, index, line, index + 2, self.indicatorSelected)
+            (line, index) = pos
+            self.store.state[self.store.row_of(marknum)] = MeltMarkStore.STATE_SELECTED
+            self.clearIndicatorRange(line, index, line, index + self.INDICATOR_WIDTH, self.indicatorPending)
+            self.fillIndicatorRange(line, index, line, index + self.INDICATOR_WIDTH, self.indicatorSelected)
             self.set_marker_selected(line)
 
-    def mark_location(self, o):
-        line = o['line']
-        index = o['col']
-        if not self.markers_counter.has_key(line):
-            self.markers_counter[line] = 0
-        self.marklocations[o['marknum']] = {'line': line, 'index': index}
-        self.indicators[str(line) + ":" + str(index)] = o
-        self.indicators[str(line) + ":" + str(index + 1)] = o
-        self.switch_marklocation_pending(o['marknum'], True)
-        logger.debug("Adding marker on line %(line)d of file %(file)s" % {'file': self.file['filename'], 'line': line})
+    def mark_locations(self, marks):
+        """
+        Mark a batch of locations (a MeltMarkView) as pending: the indicator
+        ranges are all filled and the margin marker of each line is updated
+        once, with repaints suspended until the whole batch has been applied.
+        """
+        if METRICS is not None:
+            start = time.time()
+        lines = set()
+        loaded_lines = self.lines() - 1
+        pending_mask = 1 << self.ARROW_MARKER_PENDING
+        store = self.store
+        (mlines, cols, states) = (store.line, store.col, store.state)
+
+        self.setUpdatesEnabled(False)
+        self.SendScintilla(QsciScintilla.SCI_SETINDICATORCURRENT, self.indicatorPending)
+        for row in marks.rows:
+            line = mlines[row]
+            index = cols[row]
+            if not self.loaded and line >= loaded_lines:
+                # Line has not been loaded yet
+                self.pending_marks.append(row)
+                continue
+            if states[row] != MeltMarkStore.STATE_NONE:
+                continue
+            states[row] = MeltMarkStore.STATE_PENDING
+            self.SendScintilla(QsciScintilla.SCI_INDICATORFILLRANGE, self.positionFromLineIndex(line, index), self.INDICATOR_WIDTH)
+            lines.add(line)
+
+        for line in lines:
+            if not self.markers_counter.has_key(line):
+                self.markers_counter[line] = 0
+            # Lines holding a selected mark keep their selected marker
+            if self.markers_counter[line] <= 0 and not (self.markersAtLine(line) & pending_mask):
+                self.markerAdd(line, self.ARROW_MARKER_PENDING)
+        self.setUpdatesEnabled(True)
+        logger.debug("Added %(count)d marks on %(lines)d lines of file %(file)s" % {'file': self.file.filename, 'count': len(marks), 'lines': len(lines)})
+        if METRICS is not None:
+            METRICS.observe('viewer.mark_locations', time.time() - start)
+            METRICS.count('viewer.marks', len(marks))
 
     def on_margin_clicked(self, nmargin, nline, modifiers):
         # Toggle marker for the line the margin was clicked on
@@ -296,34 +623,45 @@ class MeltSourceViewer(QsciScintilla):
 
     def on_indicator_clicked(self, line, index, state):
         logger.debug("on_indicator_clicked(%(line)d, %(index)d, %(state)s)" % {'line': line, 'index': index, 'state': state})
-        indic = self.indicators[str(line) + ":" + str(index)]
-        self.emit(MELT_SIGNAL_SOURCE_INFOLOCATION, indic)
-
-    def slot_marklocation(self, o):
-        if (self.file['filenum'] == o['filenum']):
-            self.mark_location(o)
+        # Overlapping marks are all opened
+        for marknum in self.lineindex_to_marknums(line, index):
+            self.emit(MELT_SIGNAL_SOURCE_INFOLOCATION, self.store.mark(self.store.row_of(marknum)))
+
+    def highlight_marks(self, marknums):
+        """Highlight these marks, in place of those highlighted before."""
+        self.clearIndicatorRange(0, 0, self.lines(), 0, self.indicatorMatch)
+        for marknum in marknums or ():
+            pos = self.marknum_to_lineindex(marknum)
+            if pos is not None:
+                (line, index) = pos
+                self.fillIndicatorRange(line, index, line, index + self.INDICATOR_WIDTH, self.indicatorMatch)
+
+    def slot_marklocations(self, marks):
+        self.mark_locations(marks)
 
     def slot_startinfolocation(self, o):
-        if (self.file['filenum'] == o['filenum']):
-            logger.debug("slot_startinfolocation(%(o)s)" % {'o': o})
-            try:
-                w = self.infolocs[o['marknum']]
-                w.raise_()
-                w.setFocus(True)
-            except KeyError as e:
-                mil = MeltInfoLoc()
-                QObject.connect(mil, MELT_SIGNAL_INFOLOC_QUIT, self.slot_infolocation_quit, Qt.QueuedConnection)
-                self.infolocs[o['marknum']] = mil
-                self.mil_to_marknum[mil] = o['marknum']
-                self.switch_marklocation_selected(o['marknum'])
-                self.emit(MELT_SIGNAL_INFOLOC_COMPLETE, o['marknum'])
+        logger.debug("slot_startinfolocation(%(o)s)" % {'o': o})
+        try:
+            w = self.infolocs[o.marknum]
+            w.raise_()
+            w.setFocus(True)
+        except KeyError as e:
+            mil = MeltInfoLoc()
+            QObject.connect(mil, MELT_SIGNAL_INFOLOC_QUIT, self.slot_infolocation_quit, Qt.QueuedConnection)
+            self.infolocs[o.marknum] = mil
+            self.mil_to_marknum[mil] = o.marknum
+            self.switch_marklocation_selected(o.marknum)
+            self.emit(MELT_SIGNAL_INFOLOC_COMPLETE, o.marknum)
 
     def slot_addinfolocation(self, o):
-        if (self.file['filenum'] == o['filenum']):
-            logger.debug("slot_addinfolocation(%(o)s)" % {'o': o})
-            w = self.infolocs[o['marknum']]
-            if w is not None:
-                w.push_infolocation(o)
+        logger.debug("slot_addinfolocation(%(o)s)" % {'o': o})
+        if METRICS is not None:
+            start = time.time()
+        w = self.infolocs[o.marknum]
+        if w is not None:
+            w.push_infolocation(o)
+        if METRICS is not None:
+            METRICS.observe('viewer.addinfolocation', time.time() - start)
 
     def slot_infolocation_quit(self):
         marknum = self.mil_to_marknum[self.sender()]
@@ -332,213 +670,2102 @@ class MeltSourceViewer(QsciScintilla):
             self.switch_marklocation_pending(marknum)
 
     def slot_moveToIndicator(self, indic):
-        if (self.file['filenum'] == indic['filenum']):
-            logger.debug("Received a request to move to indicator: %(indic)s" % {'indic': indic})
-            self.setCursorPosition(indic['line'], indic['col'])
-            self.setCaretLineVisible(True)
-            self.setCaretLineBackgroundColor(QColor("#ffe4e4"))
+        logger.debug("Received a request to move to indicator: %(indic)s" % {'indic': indic})
+        self.setCursorPosition(indic.line, indic.col)
+        self.setCaretLineVisible(True)
+        self.setCaretLineBackgroundColor(QColor("#ffe4e4"))
+
+class MeltMarkStore(object):
+    """
+    Every mark reported by MELT, stored once in typed columns indexed by row.
+    Rows are allocated in arrival order and never move; rows maps a marknum
+    to its row (-1 when unknown), as MELT numbers its marks from 1 upwards.
+    Marks are handed around as MeltMarkView of rows rather than as objects.
+
+    Marks are added by the worker thread while the GUI thread reads the
+    columns: a row is only published in rows once all its columns are
+    written, and the state column is only written by the GUI.
+    """
+    STATE_NONE = 0
+    STATE_PENDING = 1
+    STATE_SELECTED = 2
 
-class MeltCommandDispatcher(QObject, Thread):
+    def __init__(self):
+        self.marknum = array.array('i')
+        self.filenum = array.array('i')
+        self.line = array.array('i')
+        self.col = array.array('i')
+        self.state = array.array('b')
+        self.rows = array.array('i')
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.marknum)
+
+    def row_of(self, marknum):
+        if 0 <= marknum < len(self.rows):
+            return self.rows[marknum]
+        return -1
+
+    def __contains__(self, marknum):
+        return self.row_of(marknum) >= 0
+
+    def add(self, obj):
+        """Row of the mark, which is stored first if it is a new one."""
+        marknum = obj.marknum
+        with self.lock:
+            if marknum >= len(self.rows):
+                self.rows.extend(array.array('i', [-1]) * (max(marknum + 1, 2 * len(self.rows)) - len(self.rows)))
+            row = self.rows[marknum]
+            if row >= 0:
+                return row
+            row = len(self.marknum)
+            self.marknum.append(marknum)
+            self.filenum.append(obj.filenum)
+            self.line.append(obj.line)
+            self.col.append(obj.col)
+            self.state.append(self.STATE_NONE)
+            self.rows[marknum] = row
+            return row
+
+    def mark(self, row):
+        return meltprotocol.MarkLocation(self.marknum[row], self.filenum[row], self.line[row], self.col[row])
+
+    def view(self, rows):
+        return MeltMarkView(self, rows)
+
+    def nbytes(self):
+        columns = (self.marknum, self.filenum, self.line, self.col, self.state, self.rows)
+        return sum(len(column) * column.itemsize for column in columns)
+
+class MeltMarkView(object):
+    """
+    Read-only sequence of marks of a MeltMarkStore. Items are MarkLocation
+    built on access; bulk consumers read the store columns through rows.
+    """
+    __slots__ = ('store', 'rows')
+
+    def __init__(self, store, rows):
+        self.store = store
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        return self.store.mark(self.rows[i])
+
+    def __iter__(self):
+        mark = self.store.mark
+        for row in self.rows:
+            yield mark(row)
+
+class MeltFileRoute(QObject):
+    """
+    Per-file relay of the dispatcher signals. The viewer of a file connects to
+    the route of its filenum only, so each event is delivered to the viewer
+    that owns it instead of being broadcast to every open file. The route
+    also holds the index of the marks sent to the file, filled by the
+    dispatcher and shared by the viewer and the window.
+    """
+
+    def __init__(self, filenum):
+        QObject.__init__(self)
+        self.filenum = filenum
+        self.marks = MeltMarkIndex(filenum)
+
+class MeltInfoLocCache(object):
+    """
+    ADDINFOLOC records of the marks already asked to MELT, so that reopening
+    a mark does not need another round trip. Least recently used marks are
+    evicted once the payloads exceed budget bytes.
+    """
+    # Rough per record cost besides the strings themselves
+    RECORD_OVERHEAD = 128
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        # marknum -> [size, records], least recently used first
+        self.entries = collections.OrderedDict()
+
+    def __contains__(self, marknum):
+        return marknum in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, marknum):
+        try:
+            entry = self.entries.pop(marknum)
+        except KeyError as e:
+            if METRICS is not None:
+                METRICS.count('infoloc_cache.misses')
+            return None
+        self.entries[marknum] = entry
+        if METRICS is not None:
+            METRICS.count('infoloc_cache.hits')
+        return entry[1]
+
+    def start(self, marknum):
+        """Forget what is cached for marknum, a new answer is coming."""
+        entry = self.entries.pop(marknum, None)
+        if entry is not None:
+            self.size -= entry[0]
+        self.entries[marknum] = [0, []]
+
+    def add(self, obj):
+        try:
+            entry = self.entries.pop(obj.marknum)
+        except KeyError as e:
+            entry = [0, []]
+        cost = len(obj.ident) + len(obj.content) + self.RECORD_OVERHEAD
+        entry[0] += cost
+        entry[1].append(obj)
+        self.entries[obj.marknum] = entry
+        self.size += cost
+        self.evict()
+
+    def evict(self):
+        # The entry just added is the last one and is kept
+        while self.size > self.budget and len(self.entries) > 1:
+            (marknum, entry) = self.entries.popitem(last = False)
+            self.size -= entry[0]
+            if METRICS is not None:
+                METRICS.count('infoloc_cache.evictions')
+
+class MeltDeferredQueue(object):
+    """
+    Marks of a file waiting for its SHOWFILE to complete, kept as
+    (marknum, line, col) integer triples: they only enter the mark store
+    once the file is shown. Only limit marks are kept in memory: the older
+    ones are spilled, as raw integers, to an anonymous temporary file read
+    back by drain().
+    """
+    __slots__ = ('marks', 'limit', 'spill', 'spilled', 'created')
+    FIELDS = 3
+
+    def __init__(self, limit):
+        self.marks = array.array('i')
+        self.limit = limit
+        self.spill = None
+        self.spilled = 0
+        self.created = time.time()
+
+    def __len__(self):
+        return self.spilled + len(self.marks) / self.FIELDS
+
+    def append(self, obj):
+        """Queue a mark, returns the number of marks spilled to make room for it."""
+        self.marks.extend((obj.marknum, obj.line, obj.col))
+        if len(self.marks) < self.limit * self.FIELDS:
+            return 0
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile(prefix = "melt-probe-queue-")
+        self.marks.tofile(self.spill)
+        count = len(self.marks) / self.FIELDS
+        self.spilled += count
+        self.marks = array.array('i')
+        return count
+
+    def drain(self, filenum):
+        """Queued marks, in the order they were appended, as MarkLocation."""
+        marks = self.marks
+        if self.spill is not None:
+            marks = array.array('i')
+            self.spill.seek(0)
+            marks.fromstring(self.spill.read())
+            marks.extend(self.marks)
+        self.close()
+        return [meltprotocol.MarkLocation(marks[i], filenum, marks[i + 1], marks[i + 2]) for i in xrange(0, len(marks), self.FIELDS)]
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        self.marks = array.array('i')
+        self.spilled = 0
+
+class MeltCommandDispatcher(QObject):
+    ROUTES = {}
     FILES = {}
-    MARKS = {}
+    PENDING_MARKS = {}
+    STORE = MeltMarkStore()
     QUEUE_MARKLOCATION_MUTEX = QMutex()
     SHOWFILE_READY = {}
     QUEUE_MARKLOCATION = {}
 
+    SHOWFILE_FAILED = {}
+
     QUEUE_INFOLOC_MUTEX = QMutex()
     INFOLOC_READY = {}
     QUEUE_INFOLOC = {}
 
-    def __init__(self):
-        QObject.__init__(self)
-        Thread.__init__(self)
-        self.daemon = True
-        self.start()
+    # Marks per file queued in memory before spilling, and infolocs per mark
+    # queued before dropping
+    QUEUE_MARKS_LIMIT = 64 * 1024
+    QUEUE_INFOLOC_LIMIT = 4096
+    # Queues still waiting after QUEUE_EXPIRY seconds are dropped
+    QUEUE_EXPIRY = 300
+    QUEUE_CHECK_INTERVAL = 10
+
+    INFOLOC_CACHE_SIZE = 16 * 1024 * 1024
+    # Prefetch the infolocs of the PREFETCH_COUNT closest marks within
+    # PREFETCH_LINES of the cursor, once MELT has been quiet for PREFETCH_IDLE
+    PREFETCH_LINES = 20
+    PREFETCH_COUNT = 8
+    PREFETCH_IDLE = 0.5
 
-    def run(self):
-        print "I'm", self.getName()
+    INFOLOC_IDENT_RE = re.compile(r"(\d+):(.*)")
+    # Postings (a token in the infolocs of a mark) kept by the infoloc index
+    INFOLOC_INDEX_SIZE = 2 * 1024 * 1024
+
+    def __init__(self, cache_size = INFOLOC_CACHE_SIZE, prefetch = False, queue_limit = QUEUE_MARKS_LIMIT, queue_expiry = QUEUE_EXPIRY, index_size = INFOLOC_INDEX_SIZE):
+        QObject.__init__(self)
+        self.queue_limit = max(queue_limit, 1)
+        self.queue_expiry = queue_expiry
+        self.queue_stats = {'marks_queued': 0, 'marks_spilled': 0, 'marks_dropped': 0, 'marks_expired': 0,
+            'infolocs_queued': 0, 'infolocs_dropped': 0, 'infolocs_expired': 0, 'infolocs_unshown': 0}
+        if self.queue_expiry > 0:
+            self.queue_timer = QTimer(self)
+            self.connect(self.queue_timer, SIGNAL('timeout()'), self.slot_expireQueues)
+            self.queue_timer.start(self.QUEUE_CHECK_INTERVAL * 1000)
+        self.cache = MeltInfoLocCache(cache_size) if cache_size > 0 else None
+        self.prefetch = prefetch and self.cache is not None
+        self.infoloc_index = meltsearch.MeltInfoLocIndex(index_size) if index_size > 0 else None
+        # (serial, text) of the query followed as infolocs arrive
+        self.infoloc_query = None
+        self.infoloc_indexed = False
+        # Marks asked in the background: their answer goes to the cache only
+        self.prefetching = set()
+        # Prefetched mark whose answer is being received
+        self.prefetch_answer = None
+        # Marks the user asked MELT for, never to be taken for a prefetch
+        self.asked = set()
+        self.prefetch_cursor = None
+        self.last_batch = time.time()
+        if self.prefetch:
+            self.prefetch_timer = QTimer(self)
+            self.prefetch_timer.setSingleShot(True)
+            self.connect(self.prefetch_timer, SIGNAL('timeout()'), self.slot_prefetch)
+
+    def queued_marks(self):
+        return sum(len(queue) for queue in self.QUEUE_MARKLOCATION.values())
+
+    def stored_marks(self):
+        return len(self.STORE)
+
+    def indexed_postings(self):
+        return self.infoloc_index.entries if self.infoloc_index is not None else 0
+
+    def queued_infolocs(self):
+        return sum(len(queue) for (created, queue) in self.QUEUE_INFOLOC.values())
+
+    def count_queue(self, name, n = 1):
+        self.queue_stats[name] += n
+        if METRICS is not None:
+            METRICS.count('queue.' + name, n)
+
+    def slot_meltExited(self):
+        # Queued behind the last batch: relayed once everything MELT said
+        # has been dispatched, whichever thread the dispatcher runs on
+        self.emit(MELT_SIGNAL_MELT_EXITED)
+
+    def slot_replayDone(self):
+        self.emit(MELT_SIGNAL_REPLAY_DONE)
 
     def slot_unhandledCommand(self, cmd):
         logger.error("Unhandled command: %(comm)s" % {'comm': cmd})
 
-    def slot_dispatchCommand(self, comm):
+    def slot_dispatchBatch(self, batch):
+        logger.debug("Dispatcher receive batch of %(count)d commands" % {'count': len(batch)})
+        if METRICS is not None:
+            start = time.time()
+        self.last_batch = time.time()
+        self.emit(MELT_SIGNAL_APPEND_TRACE_COMMANDS, batch)
+        for comm in batch:
+            # One faulty command must not lose the rest of the batch
+            try:
+                self.dispatch_command(comm)
+            except Exception as e:
+                logger.exception("Failed to dispatch %(comm)s" % {'comm': comm})
+                if METRICS is not None:
+                    METRICS.count('command.failed')
+        self.flush_marks()
+        if self.infoloc_indexed:
+            self.infoloc_indexed = False
+            if self.infoloc_query is not None:
+                self.run_infoloc_query()
+        if METRICS is not None:
+            METRICS.observe('dispatcher.batch', time.time() - start)
+            METRICS.count('dispatcher.batches')
+
+    def dispatch_command(self, comm):
         logger.debug("Dispatcher receive: %(comm)s" % {'comm': comm})
 
-        o = comm.split(" ")
-        self.emit(MELT_SIGNAL_APPEND_TRACE_COMMAND, o)
-
-        sig = MELT_SIGNAL_UNHANDLED_COMMAND
-        obj = o
-        cmd = o[0]
-        if cmd == "SHOWFILE_PCD":
-            fnum = int(o[4])
-            p = o[2].strip('"')
-            if not (p.startswith("<") and p.endswith(">")):
-                p = os.path.abspath(p)
-            obj = {'command': 'showfile', 'filename': p, 'filenum': fnum}
-            sig = MELT_SIGNAL_SOURCE_SHOWFILE
-            if not self.FILES.has_key(fnum):
-                self.FILES[fnum] = {'file': obj, 'marks': {}}
-        elif cmd == "MARKLOCATION_PCD":
-            # -1 pour corriger l'affichage
-            marknum = int(o[1])
-            filenum = int(o[2])
-            obj = {'command': 'marklocation', 'marknum': marknum, 'filenum': filenum, 'line': max(int(o[3]) - 1, 0), 'col': max(int(o[4]) - 1, 0)}
-            sig = MELT_SIGNAL_SOURCE_MARKLOCATION
-            if not self.MARKS.has_key(marknum):
-                self.MARKS[marknum] = filenum
-                self.FILES[filenum]['marks'][marknum] = obj
-                self.QUEUE_INFOLOC[marknum] = []
-            # If SHOWFILE interface has not been completed, enqueue, and we will dequeue
-            # when the interface is ready
-            self.QUEUE_MARKLOCATION_MUTEX.lock()
-            if not self.SHOWFILE_READY.has_key(filenum):
+        try:
+            obj = meltprotocol.parse_line(comm)
+        except meltprotocol.MeltProtocolError as e:
+            logger.error("%(error)s" % {'error': e})
+            obj = None
+
+        if obj is None:
+            if METRICS is not None:
+                METRICS.count('command.unhandled')
+            self.emit(MELT_SIGNAL_UNHANDLED_COMMAND, comm)
+            return
+
+        if METRICS is None:
+            self.HANDLERS[type(obj)](self, obj)
+        else:
+            start = time.time()
+            self.HANDLERS[type(obj)](self, obj)
+            name = type(obj).__name__
+            METRICS.observe('handler.' + name, time.time() - start)
+            METRICS.count('command.' + name)
+
+    def dispatch_showfile(self, obj):
+        if not self.FILES.has_key(obj.filenum):
+            self.FILES[obj.filenum] = {'file': obj}
+        self.emit_command(MELT_SIGNAL_SOURCE_SHOWFILE, obj)
+
+    def dispatch_marklocation(self, obj):
+        filenum = obj.filenum
+        # If SHOWFILE interface has not been completed, enqueue, and we will dequeue
+        # when the interface is ready; queued marks are only stored then
+        self.QUEUE_MARKLOCATION_MUTEX.lock()
+        if not self.SHOWFILE_READY.has_key(filenum):
+            try:
+                if self.SHOWFILE_FAILED.has_key(filenum):
+                    # Nobody will ever show these
+                    self.count_queue('marks_dropped')
+                    return
                 try:
-                    self.QUEUE_MARKLOCATION[filenum] += [ obj ]
+                    queue = self.QUEUE_MARKLOCATION[filenum]
                 except KeyError as e:
-                    self.QUEUE_MARKLOCATION[filenum] = [ obj ]
-                finally:
-                    self.QUEUE_MARKLOCATION_MUTEX.unlock()
-                return
-            self.QUEUE_MARKLOCATION_MUTEX.unlock()
-        elif cmd == "STARTINFOLOC_PCD":
-            marknum = int(o[1])
-            filenum = self.MARKS[marknum]
-            obj = {'command': 'startinfoloc', 'marknum': marknum, 'filenum': filenum}
-            sig = MELT_SIGNAL_SOURCE_STARTINFOLOC
-        elif cmd == "ADDINFOLOC_PCD":
-            marknum = int(o[1])
-            filenum = self.MARKS[marknum]
-            obj = {'command': 'addinfoloc', 'marknum': marknum, 'filenum': filenum, 'payload': " ".join(o[2:]).split('"   "')}
-            sig = MELT_SIGNAL_SOURCE_ADDINFOLOC
-            # If INFOLOC interface has not been completed, enqueue, and we will dequeue
-            # when the interface is ready
-            self.QUEUE_INFOLOC_MUTEX.lock()
-            if not self.INFOLOC_READY.has_key(marknum):
-                self.QUEUE_INFOLOC[marknum] += [ obj ]
-                self.QUEUE_INFOLOC_MUTEX.unlock()
-                return
+                    queue = self.QUEUE_MARKLOCATION[filenum] = MeltDeferredQueue(self.queue_limit)
+                spilled = queue.append(obj)
+                self.count_queue('marks_queued')
+                if spilled:
+                    self.count_queue('marks_spilled', spilled)
+            finally:
+                self.QUEUE_MARKLOCATION_MUTEX.unlock()
+            return
+        self.QUEUE_MARKLOCATION_MUTEX.unlock()
+        row = self.STORE.add(obj)
+        # Marks are sent per file once the whole batch has been dispatched
+        try:
+            self.PENDING_MARKS[filenum].append(row)
+        except KeyError as e:
+            self.PENDING_MARKS[filenum] = array.array('i', [row])
+
+    def flush_marks(self):
+        if not self.PENDING_MARKS:
+            return
+        for filenum, rows in self.PENDING_MARKS.iteritems():
+            self.emit_marks(filenum, self.STORE.view(rows))
+        self.PENDING_MARKS.clear()
+
+    def emit_marks(self, filenum, marks):
+        logger.debug("Dispatcher emit %(count)d marks for file %(filenum)s" % {'count': len(marks), 'filenum': filenum})
+        route = self.get_route(filenum)
+        route.marks.add_marks(marks)
+        self.emit(MELT_SIGNAL_SOURCE_MARKLOCATIONS, marks)
+        route.emit(MELT_SIGNAL_SOURCE_MARKLOCATIONS, marks)
+
+    def dispatch_startinfoloc(self, obj):
+        # The infolocs of a mark come together: the previous answer is complete
+        self.end_prefetch_answer()
+        row = self.STORE.row_of(obj.marknum)
+        if row < 0:
+            logger.debug("Mark %(marknum)d is not shown, ignoring its infolocs" % {'marknum': obj.marknum})
+            return
+        obj = obj._replace(filenum = self.STORE.filenum[row])
+        if self.cache is not None:
+            self.cache.start(obj.marknum)
+        if obj.marknum in self.prefetching:
+            self.prefetch_answer = obj.marknum
+            return
+        self.asked.discard(obj.marknum)
+        self.emit_routed(MELT_SIGNAL_SOURCE_STARTINFOLOC, obj)
+
+    def end_prefetch_answer(self):
+        if self.prefetch_answer is not None:
+            # Prefetched again should the cache evict it
+            self.prefetching.discard(self.prefetch_answer)
+            self.prefetch_answer = None
+
+    def dispatch_addinfoloc(self, obj):
+        row = self.STORE.row_of(obj.marknum)
+        if row < 0:
+            # Its file is not shown (yet), and marks are only stored once it is
+            self.count_queue('infolocs_unshown')
+            return
+        obj = obj._replace(filenum = self.STORE.filenum[row])
+        if self.cache is not None:
+            self.cache.add(obj)
+        if self.infoloc_index is not None and self.infoloc_index.add(obj.marknum, obj.filenum, obj.ident, obj.content):
+            self.infoloc_indexed = True
+        if obj.marknum in self.prefetching:
+            return
+        self.route_addinfoloc(obj)
+
+    def prepare_infoloc(self, obj):
+        """Parse the ident of an ADDINFOLOC, so that the GUI thread does not have to."""
+        getident = self.INFOLOC_IDENT_RE.search(obj.ident)
+        (id, title) = (getident.group(1), getident.group(2)) if getident else (None, obj.ident)
+        return PreparedInfoLoc(obj.marknum, obj.filenum, obj.ident, obj.content, id, title)
+
+    def route_addinfoloc(self, obj):
+        obj = self.prepare_infoloc(obj)
+        marknum = obj.marknum
+        # If INFOLOC interface has not been completed, enqueue, and we will dequeue
+        # when the interface is ready
+        self.QUEUE_INFOLOC_MUTEX.lock()
+        if not self.INFOLOC_READY.has_key(marknum):
+            try:
+                (created, queue) = self.QUEUE_INFOLOC[marknum]
+            except KeyError as e:
+                (created, queue) = self.QUEUE_INFOLOC[marknum] = (time.time(), [])
+            if len(queue) < self.QUEUE_INFOLOC_LIMIT:
+                queue.append(obj)
+                self.count_queue('infolocs_queued')
+            else:
+                self.count_queue('infolocs_dropped')
             self.QUEUE_INFOLOC_MUTEX.unlock()
-        elif cmd == "SETSTATUS_PCD":
-            # ['SETSTATUS_PCD', '', '"MELT', 'version=0.9.6-d', '[melt-branch_revision_190124]"', '', '']
-            version = o[3].split('=')[1]
-            rev = o[4].replace('"', "").replace("[", "").replace("]", "")
-            obj = {'command': 'setstatus', 'version': version, 'rev': rev}
-            sig = MELT_SIGNAL_GETVERSION
+            return
+        self.QUEUE_INFOLOC_MUTEX.unlock()
+        self.emit_routed(MELT_SIGNAL_SOURCE_ADDINFOLOC, obj)
 
-        logger.debug("Dispatcher emit: %(sig)s %(obj)s" % {'sig': sig, 'obj': obj})
+    def dispatch_setstatus(self, obj):
+        self.emit_command(MELT_SIGNAL_GETVERSION, obj)
 
+    def emit_command(self, sig, obj):
+        logger.debug("Dispatcher emit: %(sig)s %(obj)s" % {'sig': sig, 'obj': obj})
         self.emit(sig, obj)
 
+    def get_route(self, filenum):
+        try:
+            return self.ROUTES[filenum]
+        except KeyError as e:
+            route = self.ROUTES[filenum] = MeltFileRoute(filenum)
+            return route
+
+    def emit_routed(self, sig, obj):
+        # Keep the order of the events: marks of the current batch first
+        self.flush_marks()
+        route = self.ROUTES.get(obj.filenum)
+        if route is None:
+            logger.debug("No route for file %(filenum)s, dropping %(obj)s" % {'filenum': obj.filenum, 'obj': obj})
+            return
+        route.emit(sig, obj)
+
+    HANDLERS = {
+        meltprotocol.ShowFile: dispatch_showfile,
+        meltprotocol.MarkLocation: dispatch_marklocation,
+        meltprotocol.StartInfoLoc: dispatch_startinfoloc,
+        meltprotocol.AddInfoLoc: dispatch_addinfoloc,
+        meltprotocol.SetStatus: dispatch_setstatus,
+    }
+
     def slot_sendInfoLocation(self, obj):
-        self.emit(MELT_SIGNAL_ASK_INFOLOCATION, "INFOLOCATION_prq " + str(obj['marknum']))
+        marknum = obj.marknum
+        cached = self.cache.get(marknum) if self.cache is not None else None
+        if cached is not None:
+            logger.debug("Infoloc of mark %(marknum)d found in cache" % {'marknum': marknum})
+            self.emit_routed(MELT_SIGNAL_SOURCE_STARTINFOLOC, meltprotocol.StartInfoLoc(marknum, obj.filenum))
+            for o in cached:
+                self.route_addinfoloc(o)
+            if marknum not in self.prefetching:
+                return
+        # A prefetched answer still on its way is shown as it arrives
+        self.prefetching.discard(marknum)
+        if cached is None:
+            self.asked.add(marknum)
+            self.emit(MELT_SIGNAL_ASK_INFOLOCATION, "INFOLOCATION_prq " + str(marknum))
+
+    def slot_infolocQuery(self, query):
+        (serial, text) = query
+        self.infoloc_query = query
+        if self.infoloc_index is None or not text.strip():
+            self.infoloc_query = None
+            self.emit(MELT_SIGNAL_INFOLOC_MATCHES, (serial, text, None))
+            return
+        self.run_infoloc_query()
+
+    def run_infoloc_query(self):
+        (serial, text) = self.infoloc_query
+        if METRICS is not None:
+            start = time.time()
+        store = self.STORE
+        rows = [store.row_of(marknum) for (marknum, filenum) in self.infoloc_index.query(text) or ()]
+        rows.sort(key = lambda row: (store.filenum[row], store.line[row], store.col[row]))
+        if METRICS is not None:
+            METRICS.observe('infoloc_index.query', time.time() - start)
+        self.emit(MELT_SIGNAL_INFOLOC_MATCHES, (serial, text, store.view(array.array('i', rows))))
+
+    def slot_cursorMoved(self, cursor):
+        self.prefetch_cursor = cursor
+        self.prefetch_timer.start(int(self.PREFETCH_IDLE * 1000))
+
+    def slot_prefetch(self):
+        if self.prefetch_cursor is None:
+            return
+        idle = time.time() - self.last_batch
+        if idle < self.PREFETCH_IDLE:
+            # MELT is busy, try again once it has been quiet long enough
+            self.prefetch_timer.start(int((self.PREFETCH_IDLE - idle) * 1000) + 1)
+            return
+        # MELT has been quiet: whatever answer was coming is complete
+        self.end_prefetch_answer()
+        (filenum, line) = self.prefetch_cursor
+        self.prefetch_cursor = None
+        route = self.ROUTES.get(filenum)
+        if route is None:
+            return
+        store = self.STORE
+        near = sorted((abs(store.line[store.row_of(marknum)] - line), marknum)
+            for marknum in route.marks.in_lines(max(line - self.PREFETCH_LINES, 0), line + self.PREFETCH_LINES))
+        near = [(distance, marknum) for (distance, marknum) in near if marknum not in self.cache and marknum not in self.prefetching and marknum not in self.asked]
+        for (distance, marknum) in near[:self.PREFETCH_COUNT]:
+            self.prefetching.add(marknum)
+            if METRICS is not None:
+                METRICS.count('infoloc_cache.prefetches')
+            self.emit(MELT_SIGNAL_ASK_INFOLOCATION, "INFOLOCATION_prq " + str(marknum))
 
     def slot_showfileComplete(self, filenum):
         self.QUEUE_MARKLOCATION_MUTEX.lock()
         try:
-            queue = self.QUEUE_MARKLOCATION[filenum]
-            logger.debug("SHOWFILE has been completed for %(filenum)s QUEUED %(queue)s" % {'filenum': filenum, 'queue': queue})
-            for obj in queue:
-                self.emit(MELT_SIGNAL_SOURCE_MARKLOCATION, obj)
+            queue = self.QUEUE_MARKLOCATION.pop(filenum)
+            logger.debug("SHOWFILE has been completed for %(filenum)s, %(count)d marks QUEUED" % {'filenum': filenum, 'count': len(queue)})
+            self.emit_marks(filenum, self.STORE.view(array.array('i', [self.STORE.add(o) for o in queue.drain(filenum)])))
         except KeyError as e:
             # nothing has been put in queue, bypassing
             pass
         self.SHOWFILE_READY[filenum] = True
         self.QUEUE_MARKLOCATION_MUTEX.unlock()
 
+    def slot_showfileFailed(self, filenum):
+        self.QUEUE_MARKLOCATION_MUTEX.lock()
+        self.SHOWFILE_FAILED[filenum] = True
+        queue = self.QUEUE_MARKLOCATION.pop(filenum, None)
+        if queue is not None:
+            logger.info("SHOWFILE failed for %(filenum)s, dropping %(count)d queued marks" % {'filenum': filenum, 'count': len(queue)})
+            self.count_queue('marks_dropped', len(queue))
+            queue.close()
+        self.QUEUE_MARKLOCATION_MUTEX.unlock()
+
     def slot_infolocComplete(self, marknum):
         self.QUEUE_INFOLOC_MUTEX.lock()
-        queue = self.QUEUE_INFOLOC[marknum]
-        logger.debug("INFOLOC has been completed for %(marknum)s QUEUED %(queue)s" % {'marknum': marknum, 'queue': queue})
+        # Popped, so that reopening the mark does not replay them a second time
+        (created, queue) = self.QUEUE_INFOLOC.pop(marknum, (None, []))
+        logger.debug("INFOLOC has been completed for %(marknum)s, %(count)d infolocs QUEUED" % {'marknum': marknum, 'count': len(queue)})
         for obj in queue:
-            self.emit(MELT_SIGNAL_SOURCE_ADDINFOLOC, obj)
+            self.emit_routed(MELT_SIGNAL_SOURCE_ADDINFOLOC, obj)
         self.INFOLOC_READY[marknum] = True
         self.QUEUE_INFOLOC_MUTEX.unlock()
 
-class MeltCommunication(QObject, Thread):
-    def __init__(self, fdin, fdout):
-        QObject.__init__(self)
-        Thread.__init__(self)
-        self.melt_stdout = fdin
-        self.melt_stdin  = fdout
+    def slot_expireQueues(self):
+        deadline = time.time() - self.queue_expiry
+        self.QUEUE_MARKLOCATION_MUTEX.lock()
+        for filenum in [filenum for (filenum, queue) in self.QUEUE_MARKLOCATION.iteritems() if queue.created < deadline]:
+            queue = self.QUEUE_MARKLOCATION.pop(filenum)
+            logger.info("SHOWFILE of %(filenum)s never completed, dropping %(count)d queued marks" % {'filenum': filenum, 'count': len(queue)})
+            self.count_queue('marks_expired', len(queue))
+            queue.close()
+        self.QUEUE_MARKLOCATION_MUTEX.unlock()
+        self.QUEUE_INFOLOC_MUTEX.lock()
+        for marknum in [marknum for (marknum, (created, queue)) in self.QUEUE_INFOLOC.iteritems() if created < deadline]:
+            (created, queue) = self.QUEUE_INFOLOC.pop(marknum)
+            self.count_queue('infolocs_expired', len(queue))
+        self.QUEUE_INFOLOC_MUTEX.unlock()
 
-        self.epoll = select.epoll()
-        self.epoll.register(self.melt_stdout, select.EPOLLIN)
+class MeltWorker(QThread):
+    """
+    Thread the dispatcher is moved to: parsing the protocol, the mark store,
+    the deferred queues and the infoloc cache, and parsing the infoloc
+    idents run in its event loop, and the GUI thread only receives batches
+    ready to display. Every connection to the dispatcher is queued, so that
+    its slots run here.
+    """
+
+    def __init__(self, dispatcher):
+        QThread.__init__(self)
+        self.dispatcher = dispatcher
+        # The timers of the dispatcher move along and are restarted in the worker
+        dispatcher.moveToThread(self)
+        self.task = None
+        self.cpu_used = 0.0
 
+    def run(self):
+        try:
+            # "<pid>/task/<tid>", so that other threads can read our /proc entry
+            self.task = os.readlink("/proc/thread-self")
+        except OSError as e:
+            pass
+        self.exec_()
+        # The entry is gone once the thread has exited
+        self.cpu_used = thread_cpu_time()
+        self.task = None
+
+    def cpu_time(self):
+        task = self.task
+        if task is None:
+            return self.cpu_used
+        return thread_cpu_time(task)
+
+    def stop(self):
+        self.quit()
+        self.wait()
+
+class MeltLineReader(object):
+    """
+    Frame the MELT command stream into lines.
+
+    The (non-blocking) descriptor is read in large chunks straight into one
+    reusable bytearray; complete lines are sliced out of it and a trailing
+    partial line is moved to the front of the buffer to be completed by the
+    next read. A buffer grown for a long line is shrunk back once that line
+    has been sliced out.
+    """
+    READ_CHUNK_SIZE = 65536
+    # Most bytes read by one read_lines call
+    READ_LIMIT = 4 * READ_CHUNK_SIZE
+
+    def __init__(self, fileno, chunk_size = READ_CHUNK_SIZE):
+        self.fileno = fileno
+        self.chunk_size = max(chunk_size, 1)
+        self.stream = io.FileIO(fileno, 'r', closefd = False)
+        self.buf = bytearray(self.chunk_size)
+        self.view = memoryview(self.buf)
+        self.end = 0
+        # The partial line up to there holds no newline
+        self.scanned = 0
+        self.eof = False
+
+        self.bytes_read = 0
+        self.lines_read = 0
+        self.started = time.time()
+
+        flags = fcntl.fcntl(fileno, fcntl.F_GETFL)
+        fcntl.fcntl(fileno, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def grow(self):
+        # A single line does not fit in the buffer, double it; reads stay
+        # chunk_size long
+        del self.view
+        self.buf.extend(bytearray(len(self.buf)))
+        self.view = memoryview(self.buf)
+
+    def shrink(self):
+        # Back to chunk_size once the long line is gone
+        del self.view
+        buf = bytearray(self.chunk_size)
+        buf[0:self.end] = self.buf[0:self.end]
+        self.buf = buf
+        self.view = memoryview(self.buf)
+
+    def fill(self):
+        """Read into the free tail of the buffer, return the number of bytes read."""
+        if self.end == len(self.buf):
+            self.grow()
+        try:
+            n = self.stream.readinto(self.view[self.end:self.end + self.chunk_size])
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+        if n is None:
+            return 0
+        if n == 0:
+            self.eof = True
+            return 0
+        self.end += n
+        self.bytes_read += n
+        return n
+
+    def read_lines(self, max_lines = None):
+        """
+        Read the descriptor, up to READ_LIMIT bytes or max_lines lines, and
+        return the list of complete, non-empty lines. What is left is read
+        by the next call, once the read notifier fires again.
+        """
+        lines = []
+        read = 0
+        while True:
+            free = min(len(self.buf) - self.end, self.chunk_size)
+            n = self.fill()
+            if n > 0:
+                self.split_lines(lines)
+                read += n
+            # A short read means the pipe has been drained
+            if n < free or self.eof:
+                break
+            # Give the event loop back rather than drain a flooding MELT
+            if read >= self.READ_LIMIT or (max_lines is not None and len(lines) >= max_lines):
+                break
+        return lines
+
+    def split_lines(self, lines):
+        buf = self.buf
+        start = 0
+        end = self.end
+        # Only the bytes read since the last scan can hold the next newline
+        nl = buf.find('\n', self.scanned, end)
+        while nl >= 0:
+            if nl > start:
+                lines.append(str(buf[start:nl]))
+                self.lines_read += 1
+            start = nl + 1
+            nl = buf.find('\n', start, end)
+        if start > 0:
+            # Keep the partial line at the front of the buffer
+            buf[0:end - start] = buf[start:end]
+            self.end = end - start
+            if len(buf) > self.chunk_size and self.end < self.chunk_size:
+                self.shrink()
+        self.scanned = self.end
+
+    def get_stats(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        return {'bytes': self.bytes_read, 'lines': self.lines_read, 'elapsed': elapsed,
+                'bytes_per_sec': self.bytes_read / elapsed, 'lines_per_sec': self.lines_read / elapsed}
+
+    def format_stats(self):
+        return "read %(bytes)d bytes, %(lines)d lines in %(elapsed).2fs: %(bytes_per_sec).0f bytes/s, %(lines_per_sec).0f lines/s" % self.get_stats()
+
+class MeltRequestWriter(object):
+    """
+    Queue of the requests to MELT, written to a non-blocking descriptor from
+    the event loop once it is writable, so that a busy MELT never blocks
+    whoever asks. A request identical to one still waiting in the queue (the
+    same mark asked twice) is merged with it.
+    """
+
+    def __init__(self, fileno):
+        self.fileno = fileno
+        self.queue = collections.deque()
+        self.queued = set()
+        # Bytes being written, and when each of the requests in it was queued
         self.buf = ""
-        self.daemon = True
+        self.buf_times = []
+        self.closed = False
+
+        self.requests_written = 0
+        self.requests_merged = 0
+        self.bytes_written = 0
+
+        flags = fcntl.fcntl(fileno, fcntl.F_GETFL)
+        fcntl.fcntl(fileno, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def __len__(self):
+        return len(self.queue) + len(self.buf_times)
+
+    def push(self, request):
+        """Queue a request, returns False if it was merged with a queued one."""
+        if self.closed:
+            return False
+        if request in self.queued:
+            self.requests_merged += 1
+            if METRICS is not None:
+                METRICS.count('writer.merged')
+            return False
+        self.queued.add(request)
+        self.queue.append((request, time.time()))
+        return True
+
+    def flush(self):
+        """Write what the descriptor accepts, returns True once everything has been written."""
+        while self.queue:
+            (request, queued) = self.queue.popleft()
+            self.queued.discard(request)
+            self.buf += request + "\n\n"
+            self.buf_times.append(queued)
+        if not self.buf:
+            return True
+        try:
+            n = os.write(self.fileno, self.buf)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        self.buf = self.buf[n:]
+        self.bytes_written += n
+        if self.buf:
+            return False
+        now = time.time()
+        self.requests_written += len(self.buf_times)
+        if METRICS is not None:
+            for queued in self.buf_times:
+                METRICS.observe('writer.latency', now - queued)
+        self.buf_times = []
+        return True
+
+    def close(self):
+        self.closed = True
+        if self.queue or self.buf:
+            logger.error("MELT is gone, dropping %(count)d requests" % {'count': len(self.queue) + len(self.buf_times)})
+        self.queue.clear()
+        self.queued.clear()
+        self.buf = ""
+        self.buf_times = []
+
+    def format_stats(self):
+        return "wrote %(requests)d requests (%(bytes)d bytes), merged %(merged)d, %(queued)d queued" % {'requests': self.requests_written, 'bytes': self.bytes_written, 'merged': self.requests_merged, 'queued': len(self)}
+
+class MeltCommunication(QObject):
+    """
+    Talks to MELT from the Qt event loop: socket notifiers tell when its
+    command pipe is readable and, while requests are waiting, when its
+    request pipe is writable, and a timer bounds how long a partial batch
+    waits. At the end of the command pipe (MELT exited, or hung up) what is
+    left is delivered, both pipes are closed and MELT_SIGNAL_MELT_EXITED is
+    emitted.
+    """
+    # Whether marks are only sent for the lines shown (see MeltSessionCommunication)
+    PAGED = False
+    # Request for the infolocs of a mark, answered by the subclasses standing for MELT
+    REQUEST_RE = re.compile(r"INFOLOCATION_prq\s+(\d+)")
+    STATS_INTERVAL = 5
+    BATCH_SIZE = 1024
+    BATCH_INTERVAL = 0.02
+
+    def __init__(self, fdin, fdout, chunk_size = MeltLineReader.READ_CHUNK_SIZE, stats = False, batch_size = BATCH_SIZE, batch_interval = BATCH_INTERVAL):
+        QObject.__init__(self)
+        self.init_pipeline(batch_size, batch_interval, stats)
+        self.melt_stdout = fdin
+        self.melt_stdin  = fdout
 
-    def run(self):
-        print "I'm", self.getName()
+        self.reader = MeltLineReader(self.melt_stdout, chunk_size)
+        self.writer = MeltRequestWriter(self.melt_stdin)
+
+        self.read_notifier = self.add_notifier(self.melt_stdout, QSocketNotifier.Read, self.slot_readable)
+        # Only enabled while requests are waiting, see arm_writer
+        self.write_notifier = self.add_notifier(self.melt_stdin, QSocketNotifier.Write, self.slot_writable)
+
+    def init_pipeline(self, batch_size, batch_interval, stats):
+        # Commands are handed to the dispatcher in batches, flushed when
+        # batch_size lines are pending or batch_interval seconds after the
+        # first pending line arrived
+        self.batch = []
+        self.batch_size = max(batch_size, 1)
+        self.batch_interval = max(batch_interval, 0)
+        self.batch_timer = QTimer(self)
+        self.batch_timer.setSingleShot(True)
+        self.connect(self.batch_timer, SIGNAL('timeout()'), self.flush_batch)
+        self.stats = stats
+        if self.stats:
+            self.stats_timer = QTimer(self)
+            self.connect(self.stats_timer, SIGNAL('timeout()'), self.report_stats)
+            self.stats_timer.start(self.STATS_INTERVAL * 1000)
+        self.notifiers = []
+        self.reader = None
+        self.writer = None
+        self.finished = False
+        self.record = None
+        self.record_lock = Lock()
+
+    def add_notifier(self, fileno, kind, slot):
+        notifier = QSocketNotifier(fileno, kind, self)
+        notifier.setEnabled(False)
+        self.connect(notifier, SIGNAL('activated(int)'), slot)
+        self.notifiers.append(notifier)
+        return notifier
+
+    def record_to(self, filename):
+        """Save the commands received and the requests sent, with timestamps."""
+        self.record = open(filename, 'w', 1 << 16)
+
+    def record_lines(self, direction, lines):
+        now = time.time()
+        with self.record_lock:
+            if self.record:
+                self.record.writelines("%(date).6f %(direction)s %(line)s\n" % {'date': now, 'direction': direction, 'line': line} for line in lines)
+
+    def close_record(self):
+        with self.record_lock:
+            if self.record:
+                self.record.close()
+                self.record = None
+
+    def start(self):
+        self.read_notifier.setEnabled(True)
+        if len(self.writer):
+            self.arm_writer()
+
+    def slot_readable(self, fileno):
+        self.queue_commands(self.reader.read_lines(self.batch_size))
+        if self.reader.eof:
+            self.shutdown()
+
+    def slot_writable(self, fileno):
         try:
-            while True:
-                events = self.epoll.poll(1)
-                for fileno, event in events:
-                    if event & select.EPOLLIN:
-                        c = os.read(fileno, 1)
-                        if c == '\n':
-                            if len(self.buf) > 0:
-                                self.command = self.buf
-                                self.emit(MELT_SIGNAL_DISPATCH_COMMAND, self.command)
-                            self.buf = ""
-                        else:
-                            self.buf += c
-                    elif event & select.EPOLLOUT:
-                        print "READY TO WRITE"
-                    elif event & select.EPOLLHUP:
-                        self.epoll.unregister(fileno)
-        finally:
-            self.epoll.unregister(self.melt_stdout)
-            self.epoll.close()
+            if self.writer.flush():
+                self.write_notifier.setEnabled(False)
+        except OSError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # MELT closed its end
+            self.write_notifier.setEnabled(False)
+            self.writer.close()
+
+    def arm_writer(self):
+        if not self.finished:
+            self.write_notifier.setEnabled(True)
+
+    def shutdown(self):
+        """MELT has exited: deliver what is left and let go of its pipes."""
+        if self.finished:
+            return
+        self.flush_batch()
+        self.report_stats()
+        self.close()
+        logger.info("MELT exited")
+        self.emit(MELT_SIGNAL_MELT_EXITED)
+
+    def close(self):
+        if self.finished:
+            return
+        self.finished = True
+        # Notifiers must not outlive their descriptors
+        for notifier in self.notifiers:
+            notifier.setEnabled(False)
+        self.batch_timer.stop()
+        if self.writer is not None:
+            self.writer.close()
+        if self.reader is not None:
+            os.close(self.melt_stdout)
+            os.close(self.melt_stdin)
+
+    def queued_requests(self):
+        # Replays and sessions answer requests themselves
+        return len(self.writer) if self.writer is not None else 0
+
+    def queue_commands(self, commands):
+        if not commands:
+            return
+        if self.record:
+            self.record_lines('>', commands)
+        if METRICS is not None:
+            METRICS.count('reader.lines', len(commands))
+        self.batch.extend(commands)
+        while len(self.batch) >= self.batch_size:
+            batch = self.batch[:self.batch_size]
+            del self.batch[:self.batch_size]
+            self.emit(MELT_SIGNAL_DISPATCH_BATCH, batch)
+        if not self.batch:
+            self.batch_timer.stop()
+        elif not self.batch_timer.isActive():
+            self.batch_timer.start(int(self.batch_interval * 1000))
+
+    def flush_batch(self):
+        self.batch_timer.stop()
+        if self.batch:
+            batch = self.batch
+            self.batch = []
+            self.emit(MELT_SIGNAL_DISPATCH_BATCH, batch)
+
+    def report_stats(self):
+        if not self.stats or self.reader is None:
+            return
+        logger.info("Reader: %(stats)s" % {'stats': self.reader.format_stats()})
+        logger.info("Writer: %(stats)s" % {'stats': self.writer.format_stats()})
 
     def send_melt_command(self, str):
         self.emit(MELT_SIGNAL_APPEND_TRACE_REQUEST, str)
-        return os.write(self.melt_stdin, str + "\n\n")
+        if self.record:
+            self.record_lines('<', [str])
+        return self.send_request(str)
+
+    def send_request(self, str):
+        """Hand a request over to MELT, returns the number of bytes sent."""
+        # Written from the event loop once the pipe is writable
+        if self.writer.push(str):
+            self.arm_writer()
+        return len(str) + 2
 
     def slot_sendInfoLocation(self, cmd):
         self.send_melt_command(cmd)
 
-class MeltTraceWindow(QMainWindow, Thread):
-    def __init__(self):
-        Thread.__init__(self)
+class MeltReplayCommunication(MeltCommunication):
+    """
+    Stands for MELT by replaying a session saved with --record (a --trace-file
+    has the same format). Commands are fed to the dispatcher at their original
+    pace or as fast as possible; the infoloc answers are held back and only
+    sent when the probe asks for that mark, as MELT would.
+    """
+    RESPONSE_RE = re.compile(r"(STARTINFOLOC_PCD|ADDINFOLOC_PCD)\s+(\d+)")
+
+    def __init__(self, recording, realtime = False, stats = False, batch_size = MeltCommunication.BATCH_SIZE, batch_interval = MeltCommunication.BATCH_INTERVAL):
+        QObject.__init__(self)
+        self.init_pipeline(batch_size, batch_interval, stats)
+        self.realtime = realtime
+        # (timestamp, command) of the unsolicited commands
+        self.commands = []
+        # marknum -> recorded answers to INFOLOCATION_prq, in the order
+        # they were given: the nth request for a mark is answered with the
+        # nth one, the last answer once they have all been replayed
+        self.responses = {}
+        # marknum -> requests already answered
+        self.requests = {}
+        self.load(recording)
+
+    def load(self, recording):
+        with open(recording) as f:
+            for entry in f:
+                try:
+                    (when, direction, line) = entry.rstrip("\n").split(" ", 2)
+                    when = float(when)
+                except ValueError as e:
+                    logger.error("Ignoring malformed recording entry: %(entry)s" % {'entry': entry})
+                    continue
+                if direction != '>':
+                    continue
+                m = self.RESPONSE_RE.match(line)
+                if m:
+                    answers = self.responses.setdefault(int(m.group(2)), [])
+                    # Each STARTINFOLOC begins a new answer
+                    if m.group(1) == "STARTINFOLOC_PCD" or not answers:
+                        answers.append([])
+                    answers[-1].append(line)
+                else:
+                    self.commands.append((when, line))
+        logger.info("Loaded %(commands)d commands and %(responses)d infoloc answers from %(file)s" % {'commands': len(self.commands), 'responses': len(self.responses), 'file': recording})
+
+    def start(self):
+        self.started = time.time()
+        self.position = 0
+        QTimer.singleShot(0, self.slot_replay)
+
+    def slot_replay(self):
+        """Feed the next commands, then come back to the event loop."""
+        now = time.time()
+        first = self.commands[0][0] if self.commands else 0
+        end = min(self.position + self.batch_size, len(self.commands))
+        if self.realtime:
+            # The commands whose time has come
+            end = self.position
+            while end < len(self.commands) and self.started + self.commands[end][0] - first <= now:
+                end += 1
+        self.queue_commands([command for (when, command) in self.commands[self.position:end]])
+        self.position = end
+        if self.position < len(self.commands):
+            delay = 0
+            if self.realtime:
+                self.flush_batch()
+                delay = max(self.started + self.commands[self.position][0] - first - time.time(), 0)
+            QTimer.singleShot(int(delay * 1000), self.slot_replay)
+            return
+        self.flush_batch()
+        self.finished = True
+        elapsed = max(time.time() - self.started, 1e-6)
+        logger.info("Replayed %(count)d commands in %(elapsed).2fs: %(rate).0f lines/s" % {'count': len(self.commands), 'elapsed': elapsed, 'rate': len(self.commands) / elapsed})
+        self.emit(MELT_SIGNAL_REPLAY_DONE)
+
+    def send_request(self, str):
+        m = self.REQUEST_RE.match(str)
+        if m:
+            marknum = int(m.group(1))
+            answers = self.responses.get(marknum)
+            response = None
+            if answers:
+                count = self.requests.get(marknum, 0)
+                self.requests[marknum] = count + 1
+                response = answers[min(count, len(answers) - 1)]
+            if response:
+                if self.record:
+                    self.record_lines('>', response)
+                self.emit(MELT_SIGNAL_DISPATCH_BATCH, list(response))
+            else:
+                logger.error("No recorded answer to %(request)s" % {'request': str})
+        return len(str) + 2
+
+class MeltNamespace(object):
+    """
+    Numbering of one compiler attached to a probe server. Filenums and
+    marknums are only unique per compiler: each connection maps its own
+    numbers to server-wide ones, shared through the server's tables, so that
+    a file shown by several compilation units is opened once. Lines are
+    rewritten with the server numbers, or dropped (None) when they would
+    repeat what the probe already knows.
+    """
+    HELLO = "CLIENT_HELLO"
+
+    def __init__(self, server, conn_id):
+        self.server = server
+        self.conn_id = conn_id
+        self.cwd = None
+        self.filenums = {}
+        # Local marknum -> server marknum, -1 when unknown
+        self.marknums = array.array('i')
+
+    def rewrite(self, line):
+        try:
+            return self.rewrite_line(line)
+        except (IndexError, ValueError) as e:
+            # Malformed, left for the dispatcher to report
+            return line
+
+    def rewrite_line(self, line):
+        command = line.split(None, 1)[0] if line.strip() else ""
+        if command == "MARKLOCATION_PCD":
+            (command, marknum, filenum, rest) = line.split(None, 3)
+            filenum = self.filenums.get(int(filenum))
+            if filenum is None:
+                logger.error("Mark %(marknum)s of connection %(conn)d on a file never shown" % {'marknum': marknum, 'conn': self.conn_id})
+                return None
+            return "%(command)s %(marknum)d %(filenum)d %(rest)s" % {'command': command, 'marknum': self.global_marknum(int(marknum)), 'filenum': filenum, 'rest': rest}
+        elif command in ("STARTINFOLOC_PCD", "ADDINFOLOC_PCD"):
+            parts = line.split(None, 2)
+            marknum = int(parts[1])
+            if marknum >= len(self.marknums) or self.marknums[marknum] < 0:
+                logger.error("Infoloc of unknown mark %(marknum)d of connection %(conn)d" % {'marknum': marknum, 'conn': self.conn_id})
+                return None
+            parts[1] = str(self.marknums[marknum])
+            return " ".join(parts)
+        elif command == "SHOWFILE_PCD":
+            return self.rewrite_showfile(line)
+        elif command == "SETSTATUS_PCD":
+            return self.server.first_status(line)
+        elif command == self.HELLO:
+            # CLIENT_HELLO "cwd" pid, sent by melt_relay
+            tokens = meltprotocol.tokenize(line)
+            self.cwd = tokens[1]
+            logger.info("Connection %(conn)d is process %(pid)s in %(cwd)s" % {'conn': self.conn_id, 'pid': tokens[2], 'cwd': self.cwd})
+            return None
+        return line
+
+    def rewrite_showfile(self, line):
+        tokens = meltprotocol.tokenize(line)
+        try:
+            (filename, filenum) = (tokens[1], int(tokens[2]))
+        except (IndexError, ValueError) as e:
+            return line
+        if not meltprotocol.is_pseudo_file(filename) and self.cwd is not None:
+            # Relative to the compiler, not to the server
+            filename = os.path.normpath(os.path.join(self.cwd, filename))
+        (global_filenum, new) = self.server.global_filenum(filename)
+        self.filenums[filenum] = global_filenum
+        if not new:
+            return None
+        return "SHOWFILE_PCD %(filename)s %(filenum)d" % {'filename': meltprotocol.quote(filename), 'filenum': global_filenum}
+
+    def global_marknum(self, marknum):
+        if marknum >= len(self.marknums):
+            self.marknums.extend(array.array('i', [-1]) * (max(marknum + 1, 2 * len(self.marknums)) - len(self.marknums)))
+        if self.marknums[marknum] < 0:
+            self.marknums[marknum] = self.server.allocate_marknum(self.conn_id, marknum)
+        return self.marknums[marknum]
+
+class MeltServerConnection(object):
+    def __init__(self, sock, conn_id, server, chunk_size):
+        self.sock = sock
+        self.fileno = sock.fileno()
+        self.conn_id = conn_id
+        self.reader = MeltLineReader(self.fileno, chunk_size)
+        self.writer = MeltRequestWriter(self.fileno)
+        self.namespace = MeltNamespace(server, conn_id)
+        self.read_notifier = server.add_notifier(self.fileno, QSocketNotifier.Read, server.slot_connReadable)
+        self.write_notifier = server.add_notifier(self.fileno, QSocketNotifier.Write, server.slot_connWritable)
+
+    def close(self):
+        for notifier in (self.read_notifier, self.write_notifier):
+            notifier.setEnabled(False)
+            notifier.deleteLater()
+        self.writer.close()
+        self.sock.close()
+
+class MeltServerCommunication(MeltCommunication):
+    """
+    Probe server: any number of compilers attach through melt_relay to a
+    Unix socket, and are served from the Qt event loop in place of the MELT
+    pipes. Their lines are renumbered by a MeltNamespace per connection
+    before being batched to the dispatcher like MELT commands, and
+    INFOLOCATION requests are sent back to the compiler owning the mark.
+    """
+
+    def __init__(self, path, chunk_size = MeltLineReader.READ_CHUNK_SIZE, stats = False, batch_size = MeltCommunication.BATCH_SIZE, batch_interval = MeltCommunication.BATCH_INTERVAL):
+        QObject.__init__(self)
+        self.init_pipeline(batch_size, batch_interval, stats)
+        self.path = path
+        self.chunk_size = chunk_size
+        self.files = {}
+        # Server marknum -> (connection, local marknum); marknums start at 1
+        self.mark_conn = array.array('i', [-1])
+        self.mark_local = array.array('i', [-1])
+        self.status_seen = False
+        self.connections = {}
+        self.conn_ids = {}
+        self.next_conn_id = 1
+        self.greetings = []
+
+        if os.path.exists(path):
+            # Left over by a server that did not shut down cleanly
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(128)
+        self.listener.setblocking(False)
+        self.listen_notifier = self.add_notifier(self.listener.fileno(), QSocketNotifier.Read, self.slot_accept)
+        logger.info("Probe server listening on %(path)s" % {'path': path})
+
+    def global_filenum(self, filename):
+        """Server filenum of a file, and whether it has just been allocated."""
+        try:
+            return (self.files[filename], False)
+        except KeyError as e:
+            filenum = self.files[filename] = len(self.files) + 1
+            return (filenum, True)
+
+    def allocate_marknum(self, conn_id, marknum):
+        self.mark_conn.append(conn_id)
+        self.mark_local.append(marknum)
+        return len(self.mark_conn) - 1
+
+    def first_status(self, line):
+        if self.status_seen:
+            return None
+        self.status_seen = True
+        return line
+
+    def start(self):
+        self.listen_notifier.setEnabled(True)
+
+    def slot_accept(self, fileno):
+        while True:
+            try:
+                (sock, address) = self.listener.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            conn = MeltServerConnection(sock, self.next_conn_id, self, self.chunk_size)
+            self.next_conn_id += 1
+            self.connections[conn.fileno] = conn
+            self.conn_ids[conn.conn_id] = conn
+            conn.read_notifier.setEnabled(True)
+            logger.info("Compiler connected, %(count)d attached" % {'count': len(self.connections)})
+            for request in self.greetings:
+                conn.writer.push(request)
+            if self.greetings:
+                self.arm_connection(conn)
+
+    def slot_connReadable(self, fileno):
+        conn = self.connections.get(fileno)
+        if conn is None:
+            return
+        lines = conn.reader.read_lines(self.batch_size)
+        self.queue_commands([line for line in (conn.namespace.rewrite(line) for line in lines) if line is not None])
+        if conn.reader.eof:
+            self.disconnect(conn)
+
+    def slot_connWritable(self, fileno):
+        conn = self.connections.get(fileno)
+        if conn is None:
+            return
+        try:
+            if conn.writer.flush():
+                conn.write_notifier.setEnabled(False)
+        except OSError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            self.disconnect(conn)
+
+    def arm_connection(self, conn):
+        conn.write_notifier.setEnabled(True)
+
+    def queued_requests(self):
+        return sum(len(conn.writer) for conn in self.connections.values())
+
+    def disconnect(self, conn):
+        del self.connections[conn.fileno]
+        del self.conn_ids[conn.conn_id]
+        self.notifiers.remove(conn.read_notifier)
+        self.notifiers.remove(conn.write_notifier)
+        conn.close()
+        logger.info("Compiler %(conn)d disconnected, %(count)d attached" % {'conn': conn.conn_id, 'count': len(self.connections)})
+
+    def report_stats(self):
+        if not self.stats:
+            return
+        for conn in self.connections.values():
+            logger.info("Connection %(conn)d: %(stats)s; %(writer)s" % {'conn': conn.conn_id, 'stats': conn.reader.format_stats(), 'writer': conn.writer.format_stats()})
+
+    def close(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.flush_batch()
+        for conn in self.connections.values():
+            conn.close()
+        self.connections.clear()
+        self.conn_ids.clear()
+        self.listen_notifier.setEnabled(False)
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def send_request(self, str):
+        m = self.REQUEST_RE.match(str)
+        if m:
+            marknum = int(m.group(1))
+            conn = None
+            if 0 < marknum < len(self.mark_conn):
+                conn = self.conn_ids.get(self.mark_conn[marknum])
+            if conn is None:
+                logger.error("The compiler owning mark %(marknum)d is gone, cannot send %(request)s" % {'marknum': marknum, 'request': str})
+                return 0
+            targets = [(conn, "INFOLOCATION_prq %(marknum)d" % {'marknum': self.mark_local[marknum]})]
+        else:
+            # Asked again to every compiler attaching later
+            self.greetings.append(str)
+            targets = [(conn, str) for conn in self.connections.values()]
+        for (conn, request) in targets:
+            if conn.writer.push(request):
+                self.arm_connection(conn)
+        return len(str) + 2
+
+def melt_relay(path, fdin, fdout):
+    """
+    Relay the MELT pipes to the probe server listening on path, instead of
+    starting a probe. Returns False when there is no server to attach to.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        sock.close()
+        return False
+    sock.sendall("%(hello)s %(cwd)s %(pid)d\n" % {'hello': MeltNamespace.HELLO, 'cwd': meltprotocol.quote(os.getcwd()), 'pid': os.getpid()})
+    epoll = select.epoll()
+    epoll.register(fdin, select.EPOLLIN)
+    epoll.register(sock.fileno(), select.EPOLLIN)
+    try:
+        while True:
+            for fileno, event in epoll.poll():
+                if fileno == fdin:
+                    data = os.read(fdin, MeltLineReader.READ_CHUNK_SIZE)
+                    if not data:
+                        return True
+                    sock.sendall(data)
+                else:
+                    data = sock.recv(MeltLineReader.READ_CHUNK_SIZE)
+                    if not data:
+                        return True
+                    while data:
+                        data = data[os.write(fdout, data):]
+    finally:
+        epoll.close()
+        sock.close()
+
+class MeltSessionCommunication(MeltCommunication):
+    """
+    Stands for MELT by serving a session saved with --session. Only the files
+    and the status are sent up front; the marks of a file are sent a page of
+    lines at a time, when the viewer shows (or comes close to) these lines,
+    and infolocs are answered from the store. Everything goes through the
+    dispatcher as protocol lines, as if MELT had sent them.
+    """
+    PAGED = True
+    PAGE_LINES = 256
+
+    def __init__(self, store, stats = False, batch_size = MeltCommunication.BATCH_SIZE, batch_interval = MeltCommunication.BATCH_INTERVAL):
+        QObject.__init__(self)
+        self.init_pipeline(batch_size, batch_interval, stats)
+        self.store = store
+        # filenum -> set of the pages already sent
+        self.pages = {}
+        # filenum -> marks stored for the file
+        self.counts = {}
+
+    def start(self):
+        QTimer.singleShot(0, self.slot_openSession)
+
+    def slot_openSession(self):
+        files = self.store.files()
+        commands = ["SHOWFILE_PCD %(filename)s %(filenum)d" % {'filename': meltprotocol.quote(o.filename), 'filenum': o.filenum} for o in files]
+        status = self.store.status()
+        if status is not None:
+            commands.append("SETSTATUS_PCD %(status)s" % {'status': meltprotocol.quote("MELT version=%(version)s [%(rev)s]" % {'version': status.version, 'rev': status.rev})})
+        logger.info("Opened session %(session)s with %(count)d files" % {'session': self.store.filename, 'count': len(files)})
+        self.queue_commands(commands)
+        self.flush_batch()
+
+    def slot_visibleLines(self, visible):
+        (filenum, first, last) = visible
+        pages = self.pages.setdefault(filenum, set())
+        commands = []
+        # One page of margin on each side, so that scrolling finds its marks ready
+        for page in xrange(max(first / self.PAGE_LINES - 1, 0), last / self.PAGE_LINES + 2):
+            if page in pages:
+                continue
+            pages.add(page)
+            for o in self.store.marks_in_lines(filenum, page * self.PAGE_LINES, (page + 1) * self.PAGE_LINES - 1):
+                commands.append("MARKLOCATION_PCD %(marknum)d %(filenum)d %(line)d %(col)d" % {'marknum': o.marknum, 'filenum': filenum, 'line': o.line + 1, 'col': o.col + 1})
+        if commands:
+            logger.debug("Sending %(count)d stored marks of file %(filenum)d" % {'count': len(commands), 'filenum': filenum})
+            self.queue_commands(commands)
+            self.flush_batch()
+
+    def send_request(self, str):
+        m = self.REQUEST_RE.match(str)
+        if m:
+            marknum = int(m.group(1))
+            infolocs = self.store.infolocs(marknum)
+            if infolocs:
+                self.emit(MELT_SIGNAL_DISPATCH_BATCH, ["STARTINFOLOC_PCD %(marknum)d" % {'marknum': marknum}] +
+                    ["ADDINFOLOC_PCD %(marknum)d %(ident)s %(content)s" % {'marknum': marknum, 'ident': meltprotocol.quote(o.ident), 'content': meltprotocol.quote(o.content)} for o in infolocs])
+            else:
+                logger.error("No stored answer to %(request)s" % {'request': str})
+        return len(str) + 2
+
+    def count_marks(self, filenum):
+        try:
+            return self.counts[filenum]
+        except KeyError as e:
+            count = self.counts[filenum] = self.store.count_marks(filenum)
+            return count
+
+class MeltTraceModel(QAbstractListModel):
+    """
+    Trace entries kept in a fixed-capacity ring buffer. The view is only told
+    about new (and dropped) entries when refresh() is called, so that bursts
+    of protocol lines are coalesced into one update.
+    """
+    COMMAND = 0
+    REQUEST = 1
+    COLORS = {COMMAND: "blue", REQUEST: "red"}
+
+    def __init__(self, capacity, parent = None):
+        QAbstractListModel.__init__(self, parent)
+        self.entries = collections.deque(maxlen = capacity)
+        self.brushes = dict((kind, QBrush(QColor(color))) for kind, color in self.COLORS.iteritems())
+        # Number of rows the view knows about, and entries appended since
+        self.rows = 0
+        self.added = 0
+
+    def append(self, when, kind, text):
+        self.entries.append((when, kind, text))
+        self.added += 1
+
+    def refresh(self):
+        """Publish the pending entries to the view, return whether there were some."""
+        if not self.added:
+            return False
+        count = len(self.entries)
+        dropped = self.rows + self.added - count
+        self.added = 0
+        if dropped >= self.rows:
+            self.beginResetModel()
+            self.rows = count
+            self.endResetModel()
+            return True
+        if dropped > 0:
+            self.beginRemoveRows(QModelIndex(), 0, dropped - 1)
+            self.rows -= dropped
+            self.endRemoveRows()
+        self.beginInsertRows(QModelIndex(), self.rows, count - 1)
+        self.rows = count
+        self.endInsertRows()
+        return True
+
+    def rowCount(self, parent = QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.rows
+
+    def data(self, index, role = Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.entries):
+            return QVariant()
+        (when, kind, text) = self.entries[index.row()]
+        if role == Qt.DisplayRole:
+            return QVariant("%(date)s %(command)s" % {'date': datetime.fromtimestamp(when).isoformat(), 'command': text})
+        elif role == Qt.ForegroundRole:
+            return QVariant(self.brushes[kind])
+        return QVariant()
+
+class MeltTraceWindow(QMainWindow):
+    CAPACITY = 10000
+    REFRESH_RATE = 4
+
+    def __init__(self, capacity = CAPACITY, refresh_rate = REFRESH_RATE, logfile = None):
         super(MeltTraceWindow, self).__init__()
+        self.model = MeltTraceModel(capacity, self)
+        # The whole trace, not only the last entries, can be streamed to disk
+        self.log = None
+        if logfile:
+            self.log = open(logfile, 'a', 1 << 16)
         self.initUI()
-        self.daemon = True
-        self.start()
+
+        self.timer = QTimer(self)
+        self.connect(self.timer, SIGNAL('timeout()'), self.slot_refresh)
+        self.timer.start(int(1000 / max(refresh_rate, 0.1)))
 
     def initUI(self):
-        self.text = QTextEdit()
-        self.setCentralWidget(self.text)
+        self.view = QListView()
+        self.view.setUniformItemSizes(True)
+        self.view.setModel(self.model)
+        self.setCentralWidget(self.view)
         self.setGeometry(0, 0, 640, 480)
         self.setWindowTitle("MELT Trace Window - PID:PPID=%(pid)d:%(ppid)d @%(host)s" % {'pid': os.getpid(), 'ppid': os.getppid(), 'host': os.uname()[1]})
         self.show()
 
-    def run(self):
-        print "I'm", self.getName()
-        pass
+    def close_log(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+
+    def slot_refresh(self):
+        scrollbar = self.view.verticalScrollBar()
+        follow = scrollbar.value() == scrollbar.maximum()
+        if self.model.refresh() and follow:
+            self.view.scrollToBottom()
 
-    def slot_appendCommand(self, command):
-        str = "<font color=\"gray\">%(date)s</font><br /><font color=\"blue\">%(command)s</font><br />" % {'date': datetime.isoformat(datetime.now()), 'command': " ".join(command)}
-        self.text.append(str)
+    def slot_appendCommands(self, commands):
+        now = time.time()
+        for command in commands:
+            self.model.append(now, MeltTraceModel.COMMAND, command)
+        if self.log:
+            self.log.writelines("%(date).6f > %(command)s\n" % {'date': now, 'command': command} for command in commands)
 
     def slot_appendRequest(self, command):
-        str = "<font color=\"gray\">%(date)s</font><br /><font color=\"red\">%(command)s</font><br />" % {'date': datetime.isoformat(datetime.now()), 'command': command}
-        self.text.append(str)
+        now = time.time()
+        self.model.append(now, MeltTraceModel.REQUEST, command)
+        if self.log:
+            self.log.write("%(date).6f < %(command)s\n" % {'date': now, 'command': command})
+
+class MeltEventLoopMonitor(QObject):
+    """
+    Measures how late a periodic timer fires to tell how long the event loop
+    was blocked, samples the gauges, and dumps the metrics when SIGUSR1 was
+    received (the Python signal handler itself only raises a flag).
+    """
+    INTERVAL = 0.05
+
+    def __init__(self, metrics, filename = None):
+        QObject.__init__(self)
+        self.metrics = metrics
+        self.filename = filename
+        self.dump_requested = False
+        self.last = time.time()
+        self.timer = QTimer(self)
+        self.connect(self.timer, SIGNAL('timeout()'), self.slot_tick)
+        self.timer.start(int(self.INTERVAL * 1000))
+        signal.signal(signal.SIGUSR1, self.on_sigusr1)
+
+    def on_sigusr1(self, signum, frame):
+        self.dump_requested = True
+
+    def slot_tick(self):
+        now = time.time()
+        lag = max(now - self.last - self.INTERVAL, 0)
+        self.last = now
+        self.metrics.observe('eventloop.lag', lag)
+        self.metrics.count('eventloop.blocked_ms', int(lag * 1000))
+        self.metrics.sample_gauges()
+        if self.dump_requested:
+            self.dump_requested = False
+            self.metrics.dump(self.filename)
+
+class MeltStatsWindow(QMainWindow):
+    REFRESH = 1000
+
+    def __init__(self, metrics):
+        QMainWindow.__init__(self)
+        self.metrics = metrics
+        self.initUI()
+        self.timer = QTimer(self)
+        self.connect(self.timer, SIGNAL('timeout()'), self.slot_refresh)
+        self.timer.start(self.REFRESH)
+
+    def initUI(self):
+        self.text = QPlainTextEdit()
+        self.text.setReadOnly(True)
+        font = QFont()
+        font.setFamily('Courier')
+        font.setFixedPitch(True)
+        self.text.setFont(font)
+        self.setCentralWidget(self.text)
+        self.setGeometry(0, 0, 640, 480)
+        self.setWindowTitle("MELT Stats Window - PID:PPID=%(pid)d:%(ppid)d @%(host)s" % {'pid': os.getpid(), 'ppid': os.getppid(), 'host': os.uname()[1]})
+        self.show()
+
+    def slot_refresh(self):
+        snap = self.metrics.snapshot()
+        lines = ["Uptime: %(elapsed).1fs" % {'elapsed': snap['elapsed_s']}, "", "Counters:"]
+        for name, c in sorted(snap['counters'].iteritems()):
+            lines.append("  %(name)-32s %(count)12d %(rate)12.1f/s" % {'name': name, 'count': c['count'], 'rate': c['rate']})
+        lines += ["", "Latencies:"]
+        for name, h in sorted(snap['histograms'].iteritems()):
+            lines.append("  %(name)-32s n=%(count)-10d mean=%(mean_ms).3fms p50<%(p50_ms).3fms p99<%(p99_ms).3fms max=%(max_ms).3fms" % dict(h, name = name))
+        lines += ["", "Queues:"]
+        for name, g in sorted(snap['gauges'].iteritems()):
+            lines.append("  %(name)-32s %(value)12d (max %(max)d)" % dict(g, name = name))
+        self.text.setPlainText("\n".join(lines))
+
+class MeltMarkIndex(object):
+    """
+    Marks of one file, kept sorted by position so that inserting a mark,
+    finding the marks around a position, covering a position or within a
+    range of lines are binary searches. A position is packed in a single
+    integer key, (line << 20) + col; several marks may share a position.
+
+    Keys are kept in buckets of at most 2 * LOAD sorted keys, with the
+    marknums alongside, so that inserting out of order only moves the rest
+    of one bucket: a full bucket is split in two. The position of a mark in
+    the whole file comes from the bucket offsets, rebuilt on the first
+    positional access after an insertion.
+
+    The index is filled by the dispatcher and read from the GUI thread, so
+    every access holds its lock.
+    """
+    COL_BITS = 20
+    LOAD = 512
+
+    def __init__(self, filenum = None):
+        self.filenum = filenum
+        # Buckets of keys and of their marknums
+        self.keys = []
+        self.marknums = []
+        # Last key of each bucket
+        self.maxes = array.array('l')
+        self.count = 0
+        # Position of the first mark of each bucket, None once stale
+        self.offsets = None
+        self.lock = Lock()
+
+    @classmethod
+    def key(cls, line, col):
+        return (line << cls.COL_BITS) + col
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, pos):
+        with self.lock:
+            if not 0 <= pos < self.count:
+                raise IndexError(pos)
+            offsets = self.get_offsets()
+            bucket = bisect.bisect_right(offsets, pos) - 1
+            pos -= offsets[bucket]
+            key = self.keys[bucket][pos]
+            return meltprotocol.MarkLocation(self.marknums[bucket][pos], self.filenum, key >> self.COL_BITS, key & ((1 << self.COL_BITS) - 1))
+
+    def get_offsets(self):
+        if self.offsets is None:
+            self.offsets = offsets = array.array('l')
+            start = 0
+            for keys in self.keys:
+                offsets.append(start)
+                start += len(keys)
+        return self.offsets
+
+    def add_marks(self, marks):
+        """Index a batch of marks (a MeltMarkView)."""
+        store = marks.store
+        (marknums, lines, cols) = (store.marknum, store.line, store.col)
+        with self.lock:
+            for row in marks.rows:
+                self.insert_key(marknums[row], self.key(lines[row], cols[row]))
+
+    def insert_key(self, marknum, key):
+        maxes = self.maxes
+        self.count += 1
+        self.offsets = None
+        if not maxes:
+            self.keys.append(array.array('l', [key]))
+            self.marknums.append(array.array('i', [marknum]))
+            maxes.append(key)
+            return
+        bucket = bisect.bisect_right(maxes, key)
+        if bucket == len(maxes):
+            # MELT mostly reports marks in increasing order, appending is
+            # the common case
+            bucket -= 1
+            keys = self.keys[bucket]
+            keys.append(key)
+            self.marknums[bucket].append(marknum)
+            maxes[bucket] = key
+        else:
+            keys = self.keys[bucket]
+            pos = bisect.bisect_right(keys, key)
+            keys.insert(pos, key)
+            self.marknums[bucket].insert(pos, marknum)
+        if len(keys) > 2 * self.LOAD:
+            self.split(bucket)
+
+    def split(self, bucket):
+        keys = self.keys[bucket]
+        marknums = self.marknums[bucket]
+        half = len(keys) / 2
+        self.keys[bucket:bucket + 1] = [keys[:half], keys[half:]]
+        self.marknums[bucket:bucket + 1] = [marknums[:half], marknums[half:]]
+        self.maxes.insert(bucket, keys[half - 1])
+
+    def between(self, lo, hi):
+        """Marknums of the marks with lo <= key < hi, in position order."""
+        with self.lock:
+            return self.find_between(lo, hi)
+
+    def find_between(self, lo, hi):
+        marknums = array.array('i')
+        bucket = bisect.bisect_left(self.maxes, lo)
+        while bucket < len(self.keys):
+            keys = self.keys[bucket]
+            end = bisect.bisect_left(keys, hi)
+            marknums.extend(self.marknums[bucket][bisect.bisect_left(keys, lo, 0, end):end])
+            if end < len(keys):
+                break
+            bucket += 1
+        return marknums
+
+    def rank(self, key, right):
+        """Marks before key, those at key included if right."""
+        with self.lock:
+            return self.find_rank(key, right)
+
+    def find_rank(self, key, right):
+        find = bisect.bisect_right if right else bisect.bisect_left
+        bucket = find(self.maxes, key)
+        if bucket == len(self.keys):
+            return self.count
+        return self.get_offsets()[bucket] + find(self.keys[bucket], key)
+
+    def covering(self, line, col, width = 1):
+        """Marknums of the marks width columns wide that cover (line, col)."""
+        return self.between(self.key(line, max(col - width + 1, 0)), self.key(line, col) + 1)
+
+    def in_lines(self, first, last):
+        """Marknums of the marks on lines first to last, in position order."""
+        return self.between(self.key(first, 0), self.key(last + 1, 0))
+
+    def position_of(self, mark):
+        """Position of a mark (a MarkLocation), or None if it is not indexed."""
+        key = self.key(mark.line, mark.col)
+        with self.lock:
+            pos = self.find_rank(key, False)
+            for marknum in self.find_between(key, key + 1):
+                if marknum == mark.marknum:
+                    return pos
+                pos += 1
+        return None
+
+    def next_from(self, line, col):
+        """Position of the first mark after (line, col), wrapping around."""
+        return self.rank(self.key(line, col), True) % len(self)
+
+    def prev_from(self, line, col):
+        """Position of the last mark before (line, col), wrapping around."""
+        return (self.rank(self.key(line, col), False) - 1) % len(self)
+
+class MeltSourceTab(QWidget):
+    """
+    Tab of one source file. It stays an empty placeholder until it is first
+    shown: the marks and infolocs routed to the file meanwhile are buffered
+    in compact form, and replayed in one go once the MeltSourceViewer has
+    been built.
+    """
+
+    def __init__(self, window, obj):
+        QWidget.__init__(self)
+        self.window = window
+        self.file = obj
+        self.viewer = None
+        # Rows in the mark store
+        self.pending_marks = array.array('i')
+        self.pending_infolocs = []
+        # Marknums matching the infoloc query, highlighted once the viewer is built
+        self.matches = None
+
+        route = window.dispatcher.get_route(obj.filenum)
+        QObject.connect(route, MELT_SIGNAL_SOURCE_MARKLOCATIONS, self.slot_marklocations, Qt.QueuedConnection)
+        QObject.connect(route, MELT_SIGNAL_SOURCE_STARTINFOLOC, self.slot_startinfolocation, Qt.QueuedConnection)
+        QObject.connect(route, MELT_SIGNAL_SOURCE_ADDINFOLOC, self.slot_addinfolocation, Qt.QueuedConnection)
+        QObject.connect(route, MELT_SIGNAL_MOVE_TO_INDICATOR, self.slot_moveToIndicator, Qt.QueuedConnection)
+
+    def ensure_viewer(self):
+        if self.viewer is not None:
+            return self.viewer
+
+        self.viewer = self.window.build_viewer(self)
+
+        marks = self.pending_marks
+        logger.debug("Built viewer for %(file)s, replaying %(count)d marks" % {'file': self.file.filename, 'count': len(marks)})
+        self.viewer.mark_locations(self.viewer.store.view(marks))
+        self.pending_marks = None
+
+        for obj in self.pending_infolocs:
+            if isinstance(obj, meltprotocol.StartInfoLoc):
+                self.viewer.slot_startinfolocation(obj)
+            else:
+                self.viewer.slot_addinfolocation(obj)
+        self.pending_infolocs = None
+        if self.matches:
+            self.viewer.highlight_marks(self.matches)
+        return self.viewer
+
+    def highlight_marks(self, marknums):
+        if not marknums and not self.matches:
+            return
+        self.matches = marknums
+        if self.viewer is not None:
+            self.viewer.highlight_marks(marknums)
+
+    def slot_marklocations(self, marks):
+        if self.viewer is None:
+            self.pending_marks.extend(marks.rows)
+        else:
+            self.viewer.slot_marklocations(marks)
+
+    def slot_startinfolocation(self, o):
+        if self.viewer is None:
+            self.pending_infolocs.append(o)
+        else:
+            self.viewer.slot_startinfolocation(o)
+
+    def slot_addinfolocation(self, o):
+        if self.viewer is None:
+            self.pending_infolocs.append(o)
+        else:
+            self.viewer.slot_addinfolocation(o)
+
+    def slot_moveToIndicator(self, indic):
+        if self.viewer is not None:
+            self.viewer.slot_moveToIndicator(indic)
+
+class MeltSearchIndexer(QObject):
+    """
+    Owner of the search index, moved to a thread of its own: the source
+    files are read and indexed there as MELT shows them, and queries are
+    answered there too, so that neither blocks the GUI. Files larger than
+    max_size are not indexed.
+    """
+    RESULT_LIMIT = 1000
+
+    def __init__(self, max_size):
+        QObject.__init__(self)
+        self.index = meltsearch.MeltSearchIndex()
+        self.max_size = max_size
+        # Serial of the last query asked, set from the GUI thread: queries
+        # overtaken by a newer one while waiting are not run
+        self.latest = 0
+
+    def slot_indexFile(self, obj):
+        if METRICS is not None:
+            start = time.time()
+        try:
+            if os.path.getsize(obj.filename) > self.max_size:
+                logger.info("Not indexing %(file)s, larger than %(size)d bytes" % {'file': obj.filename, 'size': self.max_size})
+                return
+            with open(obj.filename, 'rb') as f:
+                content = f.read()
+        except (IOError, OSError) as e:
+            logger.error("Cannot index %(file)s: %(error)s" % {'file': obj.filename, 'error': e})
+            return
+        if not self.index.add_file(obj.filenum, obj.filename, content):
+            return
+        logger.debug("Indexed %(file)s, %(count)d files indexed" % {'file': obj.filename, 'count': len(self.index)})
+        if METRICS is not None:
+            METRICS.observe('search.index', time.time() - start)
+            METRICS.count('search.indexed_bytes', len(content))
+
+    def slot_search(self, query):
+        (serial, text) = query
+        if serial < self.latest:
+            return
+        if METRICS is not None:
+            start = time.time()
+        (matches, truncated) = self.index.search(text, self.RESULT_LIMIT)
+        if METRICS is not None:
+            METRICS.observe('search.query', time.time() - start)
+        self.emit(MELT_SIGNAL_SEARCH_RESULTS, (serial, text, matches, truncated))
+
+class MeltSearchPanel(QDockWidget):
+    """
+    Search across every file MELT showed: results are listed as the query is
+    typed, and activating one opens its tab on the match.
+    """
+    # Typing pause, in ms, before the query is run
+    SEARCH_DELAY = 150
+    # Shorter queries have no trigram to narrow the candidate files
+    MIN_QUERY = 3
+
+    def __init__(self, window):
+        QDockWidget.__init__(self, "Search all files", window)
+        self.setObjectName("searchall")
+        self.window = window
+        self.serial = 0
+        self.matches = []
+        self.length = 0
+
+        self.indexer = MeltSearchIndexer(MeltSourceViewer.LARGE_FILE_THRESHOLD)
+        self.thread = QThread()
+        self.indexer.moveToThread(self.thread)
+        QObject.connect(self, MELT_SIGNAL_INDEX_FILE, self.indexer.slot_indexFile, Qt.QueuedConnection)
+        QObject.connect(self, MELT_SIGNAL_SEARCH, self.indexer.slot_search, Qt.QueuedConnection)
+        QObject.connect(self.indexer, MELT_SIGNAL_SEARCH_RESULTS, self.slot_results, Qt.QueuedConnection)
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.connect(self.timer, SIGNAL('timeout()'), self.slot_search)
+        self.initUI()
+        self.thread.start()
+
+    def initUI(self):
+        widget = QWidget()
+        layout = QVBoxLayout()
+        self.query = QLineEdit()
+        self.status = QLabel()
+        self.results = QListWidget()
+        self.results.setUniformItemSizes(True)
+        layout.addWidget(self.query)
+        layout.addWidget(self.status)
+        layout.addWidget(self.results)
+        widget.setLayout(layout)
+        self.setWidget(widget)
+        self.connect(self.query, SIGNAL('textChanged(const QString&)'), self.slot_queryChanged)
+        self.connect(self.query, SIGNAL('returnPressed()'), self.slot_search)
+        self.connect(self.results, SIGNAL('itemActivated(QListWidgetItem*)'), self.slot_activated)
+
+    def index_file(self, obj):
+        if not meltprotocol.is_pseudo_file(obj.filename):
+            self.emit(MELT_SIGNAL_INDEX_FILE, obj)
+
+    def focus(self):
+        self.show()
+        self.query.setFocus()
+        self.query.selectAll()
+
+    def slot_queryChanged(self, text):
+        self.timer.start(self.SEARCH_DELAY)
+
+    def slot_search(self):
+        self.timer.stop()
+        text = unicode(self.query.text()).encode('utf-8')
+        self.serial += 1
+        self.indexer.latest = self.serial
+        if len(text) < self.MIN_QUERY:
+            self.matches = []
+            self.results.clear()
+            self.status.setText("")
+            return
+        self.emit(MELT_SIGNAL_SEARCH, (self.serial, text))
+
+    def slot_results(self, answer):
+        (serial, text, matches, truncated) = answer
+        if serial != self.serial:
+            return
+        self.matches = matches
+        self.length = len(text)
+        self.results.clear()
+        for match in matches:
+            label = "%(file)s:%(line)d: %(text)s" % {'file': self.window.get_filename(self.window.filemaps[match.filenum].file.filename),
+                'line': match.line + 1, 'text': match.text.strip()}
+            self.results.addItem(label.decode('utf-8', 'replace'))
+        files = len(set(match.filenum for match in matches))
+        self.status.setText("%(count)d%(more)s matches in %(files)d files" % {'count': len(matches), 'more': "+" if truncated else "", 'files': files})
+
+    def slot_activated(self, item):
+        match = self.matches[self.results.row(item)]
+        self.window.jump_to(match.filenum, match.line, match.col, self.length)
+
+    def stop(self):
+        self.thread.quit()
+        self.thread.wait()
+
+class MeltInfoLocQueryPanel(QDockWidget):
+    """
+    Query of the infoloc index of the dispatcher: the marks whose infolocs
+    hold every identifier typed are listed and highlighted in their files,
+    and the list follows the infolocs arriving afterwards.
+    """
+    QUERY_DELAY = 150
+    # Longest list shown, every match is highlighted
+    LIST_LIMIT = 1000
+
+    def __init__(self, window):
+        QDockWidget.__init__(self, "Query infolocs", window)
+        self.setObjectName("infolocquery")
+        self.window = window
+        self.serial = 0
+        self.rows = array.array('i')
+
+        QObject.connect(self, MELT_SIGNAL_INFOLOC_QUERY, window.dispatcher.slot_infolocQuery, Qt.QueuedConnection)
+        QObject.connect(window.dispatcher, MELT_SIGNAL_INFOLOC_MATCHES, self.slot_matches, Qt.QueuedConnection)
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.connect(self.timer, SIGNAL('timeout()'), self.slot_query)
+        self.initUI()
+
+    def initUI(self):
+        widget = QWidget()
+        layout = QVBoxLayout()
+        self.query = QLineEdit()
+        self.query.setToolTip("Identifiers the infolocs of a mark must all mention, e.g. rel_x D.21223")
+        self.status = QLabel()
+        self.results = QListWidget()
+        self.results.setUniformItemSizes(True)
+        layout.addWidget(self.query)
+        layout.addWidget(self.status)
+        layout.addWidget(self.results)
+        widget.setLayout(layout)
+        self.setWidget(widget)
+        self.connect(self.query, SIGNAL('textChanged(const QString&)'), self.slot_queryChanged)
+        self.connect(self.query, SIGNAL('returnPressed()'), self.slot_query)
+        self.connect(self.results, SIGNAL('itemActivated(QListWidgetItem*)'), self.slot_activated)
+
+    def focus(self):
+        self.show()
+        self.query.setFocus()
+        self.query.selectAll()
+
+    def slot_queryChanged(self, text):
+        self.timer.start(self.QUERY_DELAY)
+
+    def slot_query(self):
+        self.timer.stop()
+        self.serial += 1
+        # An empty query stops the dispatcher from following new infolocs
+        self.emit(MELT_SIGNAL_INFOLOC_QUERY, (self.serial, unicode(self.query.text()).encode('utf-8')))
 
-class MeltSourceWindow(QMainWindow, Thread):
+    def slot_matches(self, answer):
+        (serial, text, marks) = answer
+        if serial != self.serial:
+            return
+        self.results.clear()
+        if marks is None:
+            self.rows = array.array('i')
+            self.status.setText("")
+            self.window.highlight_marks(None)
+            return
+        store = marks.store
+        self.rows = marks.rows[:self.LIST_LIMIT]
+        for row in self.rows:
+            self.results.addItem("%(file)s:%(line)d:%(col)d: mark %(marknum)d" % {'file': self.window.get_filename(self.window.filemaps[store.filenum[row]].file.filename),
+                'line': store.line[row] + 1, 'col': store.col[row] + 1, 'marknum': store.marknum[row]})
+        files = len(set(store.filenum[row] for row in marks.rows))
+        self.status.setText("%(count)d marks in %(files)d files%(more)s" % {'count': len(marks), 'files': files,
+            'more': " (first %(limit)d listed)" % {'limit': self.LIST_LIMIT} if len(marks) > self.LIST_LIMIT else ""})
+        self.window.highlight_marks(marks)
+
+    def slot_activated(self, item):
+        self.window.jump_to_mark(self.rows[self.results.row(item)])
+
+class MeltSourceWindow(QMainWindow):
     LBL_COUNT = "Count: %(cnt)d"
     COUNTS = {}
     LBL_VERSION = "Version: %(version)s"
     LBL_REVISION = "Revision: %(revision)s"
-    INDICATORS = {}
     CURRENT_INDICATOR = {}
     LBL_CURRENT = "Current: %(cur)d"
 
-    def __init__(self, dispatcher, comm):
-        Thread.__init__(self)
+    def __init__(self, dispatcher, comm, search = True):
         super(MeltSourceWindow, self).__init__()
         self.dispatcher = dispatcher
         self.comm = comm
+        self.search = MeltSearchPanel(self) if search else None
+        self.infoloc_query = MeltInfoLocQueryPanel(self) if dispatcher.infoloc_index is not None else None
         self.filemaps = {}
         self.filemaps_reverse = {}
         self.initUI()
@@ -547,13 +2774,12 @@ class MeltSourceWindow(QMainWindow, Thread):
         QObject.connect(self.dispatcher, MELT_SIGNAL_GETVERSION, self.slot_getversion, Qt.QueuedConnection)
         QObject.connect(self, MELT_SIGNAL_UPDATECOUNT, self.slot_updateCount, Qt.QueuedConnection)
         QObject.connect(self, MELT_SIGNAL_UPDATECURRENT, self.slot_updateCurrent, Qt.QueuedConnection)
-        self.daemon = True
-        self.start()
 
     def initUI(self):
         window = QWidget()
         self.tabs = QTabWidget()
         self.tabs.setTabPosition(QTabWidget.West)
+        self.connect(self.tabs, SIGNAL('currentChanged(int)'), self.slot_currentTabChanged)
         self.header = QHBoxLayout()
         self.vlayout = QVBoxLayout()
         self.vlayout.addLayout(self.header)
@@ -561,6 +2787,10 @@ class MeltSourceWindow(QMainWindow, Thread):
         window.setLayout(self.vlayout)
         window.show()
         self.setCentralWidget(window)
+        if self.search:
+            self.addDockWidget(Qt.BottomDockWidgetArea, self.search)
+        if self.infoloc_query:
+            self.addDockWidget(Qt.BottomDockWidgetArea, self.infoloc_query)
         self.setGeometry(0, 0, 640, 480)
         self.setWindowTitle("MELT Source Window - PID:PPID=%(pid)d:%(ppid)d @%(host)s" % {'pid': os.getpid(), 'ppid': os.getppid(), 'host': os.uname()[1]})
 
@@ -568,86 +2798,100 @@ class MeltSourceWindow(QMainWindow, Thread):
 
         self.comm.send_melt_command("VERSION_prq")
 
-    def run(self):
-        print "I'm", self.getName()
-        pass
-
     def get_filename(self, path):
         (dir, fname) = os.path.split(path)
         return fname
 
     def get_count(self, filenum):
-        return self.LBL_COUNT % {'cnt': self.COUNTS[filenum]}
+        # A paged session only sends the marks of the lines shown
+        count = self.comm.count_marks(filenum) if self.comm.PAGED else self.COUNTS[filenum]
+        return self.LBL_COUNT % {'cnt': count}
 
     def get_current(self, filenum):
-        return self.LBL_CURRENT % {'cur': self.CURRENT_INDICATOR[filenum]}
+        current = self.CURRENT_INDICATOR[filenum]
+        pos = self.dispatcher.get_route(filenum).marks.position_of(current) if current is not None else None
+        return self.LBL_CURRENT % {'cur': pos or 0}
 
     def slot_showfile(self, o):
-        qw = QWidget()
-        layout = QVBoxLayout()
-        qw.setLayout(layout)
-
-        if o['filename'] == "/dev/null":
+        if o.filename == "/dev/null":
             logger.error('Cannot open /dev/null, exiting.')
             sys.exit(0)
 
-        if os.path.exists(o['filename']) or (o['filename'].startswith("<") and o['filename'].endswith(">")):
-            txt = MeltSourceViewer(qw, o)
-            lbl = QLabel(o['filename'])
-            lbl.setObjectName("filename")
-            self.COUNTS[o['filenum']] = 0
-            cnt = QLabel(self.get_count(o['filenum']))
-            cnt.setObjectName("count")
-            self.CURRENT_INDICATOR[o['filenum']] = 0
-            cur = QLabel(self.get_current(o['filenum']))
-            cur.setObjectName("current")
-            hlayout = QHBoxLayout()
-            hlayout.addWidget(cnt)
-            hlayout.addWidget(cur)
-            searchBar = QToolBar()
-            searchBar.setObjectName("search")
-            prevIndic = searchBar.addAction("<", self.slot_prevIndicator)
-            prevIndic.setToolTip("Go to previous GCC mark")
-            nextIndic = searchBar.addAction(">", self.slot_nextIndicator)
-            nextIndic.setToolTip("Go to next GCC mark")
-            searchBar.addSeparator()
-            searchLabel = QLabel("Search: ")
-            searchText = QLineEdit()
-            searchBar.addWidget(searchLabel)
-            searchBar.addWidget(searchText)
-            searchReset = searchBar.addAction("Reset", self.slot_searchReset)
-            searchNext = searchBar.addAction("Next", self.slot_searchNext)
-            QObject.connect(self.dispatcher, MELT_SIGNAL_SOURCE_MARKLOCATION, txt.slot_marklocation, Qt.QueuedConnection)
-            QObject.connect(txt, MELT_SIGNAL_SOURCE_INFOLOCATION, self.dispatcher.slot_sendInfoLocation, Qt.QueuedConnection)
-            QObject.connect(txt, MELT_SIGNAL_INFOLOC_COMPLETE, self.dispatcher.slot_infolocComplete, Qt.QueuedConnection)
-            QObject.connect(self.dispatcher, MELT_SIGNAL_SOURCE_STARTINFOLOC, txt.slot_startinfolocation, Qt.QueuedConnection)
-            QObject.connect(self.dispatcher, MELT_SIGNAL_SOURCE_ADDINFOLOC, txt.slot_addinfolocation, Qt.QueuedConnection)
-            QObject.connect(self, MELT_SIGNAL_MOVE_TO_INDICATOR, txt.slot_moveToIndicator, Qt.QueuedConnection)
-            layout.addWidget(lbl)
-            layout.addWidget(txt)
-            layout.addLayout(hlayout)
-            layout.addWidget(searchBar)
-            # searchBar.hide()
-            self.tabs.addTab(qw, "[%(fnum)s] %(filename)s" % {'fnum': o['filenum'], 'filename': self.get_filename(o['filename'])})
-            self.filemaps[o['filenum']] = qw
-            self.filemaps_reverse[txt] = o['filenum']
-            logger.debug("Mapping %(filenum)s with object %(object)s" % {'filenum': o['filenum'], 'object': txt.objectName()})
-            self.emit(MELT_SIGNAL_SHOWFILE_COMPLETE, o['filenum'])
+        if os.path.exists(o.filename) or meltprotocol.is_pseudo_file(o.filename):
+            self.COUNTS[o.filenum] = 0
+            self.CURRENT_INDICATOR[o.filenum] = None
+            # The viewer itself is only built when the tab is first shown
+            tab = MeltSourceTab(self, o)
+            self.tabs.addTab(tab, "[%(fnum)s] %(filename)s" % {'fnum': o.filenum, 'filename': self.get_filename(o.filename)})
+            self.filemaps[o.filenum] = tab
+            if self.search:
+                self.search.index_file(o)
+            self.emit(MELT_SIGNAL_SHOWFILE_COMPLETE, o.filenum)
         else:
-            logger.error("Unable to open '%(file)s'" % {'file': o['filename']})
+            logger.error("Unable to open '%(file)s'" % {'file': o.filename})
+            self.emit(MELT_SIGNAL_SHOWFILE_FAILED, o.filenum)
             return
-            err = QErrorMessage("Unable to open '%(file)s'" % {'file': o['filename']})
+            err = QErrorMessage("Unable to open '%(file)s'" % {'file': o.filename})
             err.showMessage()
 
-    def slot_marklocation(self, obj):
-        self.COUNTS[obj['filenum']] += 1
-        try:
-            self.INDICATORS[obj['filenum']] += [ obj ]
-            self.INDICATORS[obj['filenum']].sort(key=lambda x: x['line'], reverse=False)
-        except KeyError as e:
-            self.INDICATORS[obj['filenum']] = [ obj ]
-            self.CURRENT_INDICATOR[obj['filenum']] = 0
-        self.emit(MELT_SIGNAL_UPDATECOUNT, obj['filenum'])
+    def slot_currentTabChanged(self, index):
+        tab = self.tabs.widget(index)
+        if tab:
+            tab.ensure_viewer()
+
+    def build_viewer(self, tab):
+        o = tab.file
+        layout = QVBoxLayout()
+        tab.setLayout(layout)
+
+        txt = MeltSourceViewer(tab, o)
+        lbl = QLabel(o.filename)
+        lbl.setObjectName("filename")
+        cnt = QLabel(self.get_count(o.filenum))
+        cnt.setObjectName("count")
+        cur = QLabel(self.get_current(o.filenum))
+        cur.setObjectName("current")
+        hlayout = QHBoxLayout()
+        hlayout.addWidget(cnt)
+        hlayout.addWidget(cur)
+        searchBar = QToolBar()
+        searchBar.setObjectName("search")
+        prevIndic = searchBar.addAction("<", self.slot_prevIndicator)
+        prevIndic.setToolTip("Go to previous GCC mark")
+        nextIndic = searchBar.addAction(">", self.slot_nextIndicator)
+        nextIndic.setToolTip("Go to next GCC mark")
+        searchBar.addSeparator()
+        searchLabel = QLabel("Search: ")
+        searchText = QLineEdit()
+        searchBar.addWidget(searchLabel)
+        searchBar.addWidget(searchText)
+        searchReset = searchBar.addAction("Reset", self.slot_searchReset)
+        searchNext = searchBar.addAction("Next", self.slot_searchNext)
+        QObject.connect(txt, MELT_SIGNAL_SOURCE_INFOLOCATION, self.dispatcher.slot_sendInfoLocation, Qt.QueuedConnection)
+        QObject.connect(txt, MELT_SIGNAL_INFOLOC_COMPLETE, self.dispatcher.slot_infolocComplete, Qt.QueuedConnection)
+        if self.dispatcher.prefetch:
+            QObject.connect(txt, MELT_SIGNAL_CURSOR_MOVED, self.dispatcher.slot_cursorMoved, Qt.QueuedConnection)
+        if self.comm.PAGED:
+            QObject.connect(txt, MELT_SIGNAL_VISIBLE_LINES, self.comm.slot_visibleLines, Qt.QueuedConnection)
+            txt.slot_scrolled()
+        layout.addWidget(lbl)
+        layout.addWidget(txt)
+        layout.addLayout(hlayout)
+        layout.addWidget(searchBar)
+        # searchBar.hide()
+        self.filemaps_reverse[txt] = o.filenum
+        logger.debug("Mapping %(filenum)s with object %(object)s" % {'filenum': o.filenum, 'object': txt.objectName()})
+        return txt
+
+    def slot_marklocations(self, marks):
+        if METRICS is not None:
+            start = time.time()
+        store = marks.store
+        filenum = store.filenum[marks.rows[0]]
+        self.COUNTS[filenum] += len(marks)
+        self.emit(MELT_SIGNAL_UPDATECOUNT, filenum)
+        if METRICS is not None:
+            METRICS.observe('window.marklocations', time.time() - start)
 
     def slot_updateCount(self, fnum):
         cnt = self.filemaps[fnum].findChild(QLabel, "count")
@@ -660,7 +2904,16 @@ class MeltSourceWindow(QMainWindow, Thread):
             cur.setText(self.get_current(fnum))
 
     def keyReleaseEvent(self, ev):
-        if (ev.modifiers() == Qt.ControlModifier and ev.key() == Qt.Key_F):
+        if self.search and ev.modifiers() == (Qt.ControlModifier | Qt.ShiftModifier) and ev.key() == Qt.Key_F:
+            ev.accept()
+            self.search.focus()
+        elif self.infoloc_query and ev.modifiers() == (Qt.ControlModifier | Qt.ShiftModifier) and ev.key() == Qt.Key_I:
+            ev.accept()
+            self.infoloc_query.focus()
+        elif any(panel and panel.isAncestorOf(QApplication.focusWidget()) for panel in (self.search, self.infoloc_query)):
+            # Typed in a panel
+            ev.ignore()
+        elif (ev.modifiers() == Qt.ControlModifier and ev.key() == Qt.Key_F):
             ev.accept()
             searchBar = self.tabs.currentWidget().findChild(QToolBar, "search")
             if searchBar.isHidden():
@@ -697,6 +2950,38 @@ class MeltSourceWindow(QMainWindow, Thread):
             searchText.setCursorPosition(0, 0)
             searchText.findFirst(findText, False, False, False, False)
 
+    def jump_to(self, filenum, line, col, length):
+        tab = self.filemaps.get(filenum)
+        if tab is None:
+            return
+        self.tabs.setCurrentWidget(tab)
+        tab.ensure_viewer().show_match(line, col, length)
+
+    def jump_to_mark(self, row):
+        store = self.dispatcher.STORE
+        tab = self.filemaps.get(store.filenum[row])
+        if tab is None:
+            return
+        self.tabs.setCurrentWidget(tab)
+        tab.ensure_viewer().slot_moveToIndicator(store.mark(row))
+
+    def highlight_marks(self, marks):
+        """Highlight the marks of a MeltMarkView in their files, None clears them."""
+        matches = {}
+        if marks is not None:
+            store = marks.store
+            for row in marks.rows:
+                try:
+                    matches[store.filenum[row]].append(store.marknum[row])
+                except KeyError as e:
+                    matches[store.filenum[row]] = array.array('i', [store.marknum[row]])
+        for (filenum, tab) in self.filemaps.iteritems():
+            tab.highlight_marks(matches.get(filenum))
+
+    def stop_search(self):
+        if self.search:
+            self.search.stop()
+
     def slot_prevIndicator(self):
         self.move_indicator(-1)
 
@@ -708,39 +2993,191 @@ class MeltSourceWindow(QMainWindow, Thread):
         if searchText:
             try:
                 filenum = self.filemaps_reverse[searchText]
-                newpos = (self.CURRENT_INDICATOR[filenum] + sens) % len(self.INDICATORS[filenum])
-                self.CURRENT_INDICATOR[filenum] = newpos
+                index = self.dispatcher.get_route(filenum).marks
+                if not len(index):
+                    return
+                # The current mark is kept rather than its position, which
+                # marks inserted before it shift
+                current = self.CURRENT_INDICATOR[filenum]
+                (line, col) = searchText.getCursorPosition()
+                if current is not None and (current.line, current.col) == (line, col):
+                    # Still on the current mark, step to its neighbour
+                    newpos = (index.position_of(current) + sens) % len(index)
+                elif sens > 0:
+                    newpos = index.next_from(line, col)
+                else:
+                    newpos = index.prev_from(line, col)
                 self.set_indicator(filenum, newpos)
             except KeyError as e:
                 logger.error("Could not find associated file with %(obj)s" % {'obj': searchText})
 
     def set_indicator(self, file, id):
-        if self.INDICATORS[file][id]:
-            indic = self.INDICATORS[file][id]
-            logger.debug("Moving indicator of %(file)s to %(pos)d at (%(line)d,%(col)d)" % {'file': file, 'pos': id, 'line': indic['line'], 'col': indic['col']})
-            self.emit(MELT_SIGNAL_MOVE_TO_INDICATOR, indic)
+        route = self.dispatcher.get_route(file)
+        if 0 <= id < len(route.marks):
+            indic = self.CURRENT_INDICATOR[file] = route.marks[id]
+            logger.debug("Moving indicator of %(file)s to %(pos)d at (%(line)d,%(col)d)" % {'file': file, 'pos': id, 'line': indic.line, 'col': indic.col})
+            route.emit(MELT_SIGNAL_MOVE_TO_INDICATOR, indic)
             self.emit(MELT_SIGNAL_UPDATECURRENT, file)
         else:
             logger.error("No indicator %(id)d" % {'id': id})
 
     def slot_getversion(self, obj):
-        logger.debug("Received version: %(version)s; revision: %(revision)s" % {'version': obj['version'], 'revision': obj['rev']})
-        self.version = QLabel(self.LBL_VERSION % {'version': obj['version']})
-        self.revision = QLabel(self.LBL_REVISION % {'revision': obj['rev']})
+        logger.debug("Received version: %(version)s; revision: %(revision)s" % {'version': obj.version, 'revision': obj.rev})
+        self.version = QLabel(self.LBL_VERSION % {'version': obj.version})
+        self.revision = QLabel(self.LBL_REVISION % {'revision': obj.rev})
         self.header.addWidget(self.version)
         self.header.addWidget(self.revision)
 
+class MeltHeadlessSink(QObject):
+    """
+    Stand-in for MeltSourceWindow when running without a GUI: files, marks,
+    infolocs and status are written as JSON lines (one object per line with a
+    "type" key) instead of being shown, so that batch builds can query them
+    afterwards. Nothing here reads the source files, which keeps the
+    dispatcher, and thus the MELT pipe, going at full speed.
+    """
+
+    def __init__(self, dispatcher, comm, output = None, infolocs = False):
+        QObject.__init__(self)
+        self.dispatcher = dispatcher
+        self.comm = comm
+        self.infolocs = infolocs
+        if output and output != "-":
+            self.output = open(output, 'w')
+        else:
+            self.output = sys.stdout
+
+        QObject.connect(self.dispatcher, MELT_SIGNAL_SOURCE_SHOWFILE, self.slot_showfile, Qt.QueuedConnection)
+        QObject.connect(self.dispatcher, MELT_SIGNAL_GETVERSION, self.slot_getversion, Qt.QueuedConnection)
+        QObject.connect(self, MELT_SIGNAL_SOURCE_INFOLOCATION, self.dispatcher.slot_sendInfoLocation, Qt.QueuedConnection)
+        QObject.connect(self, MELT_SIGNAL_INFOLOC_COMPLETE, self.dispatcher.slot_infolocComplete, Qt.QueuedConnection)
+
+        self.comm.send_melt_command("VERSION_prq")
+
+    def write(self, record):
+        self.output.write(json.dumps(record, sort_keys = True) + "\n")
+
+    def slot_showfile(self, o):
+        self.write({'type': 'file', 'filenum': o.filenum, 'filename': o.filename, 'exists': os.path.exists(o.filename)})
+        route = self.dispatcher.get_route(o.filenum)
+        QObject.connect(route, MELT_SIGNAL_SOURCE_STARTINFOLOC, self.slot_startinfolocation, Qt.QueuedConnection)
+        QObject.connect(route, MELT_SIGNAL_SOURCE_ADDINFOLOC, self.slot_addinfolocation, Qt.QueuedConnection)
+        self.emit(MELT_SIGNAL_SHOWFILE_COMPLETE, o.filenum)
+
+    def slot_marklocations(self, marks):
+        for o in marks:
+            self.write({'type': 'mark', 'marknum': o.marknum, 'filenum': o.filenum, 'line': o.line, 'col': o.col})
+            if self.infolocs:
+                self.emit(MELT_SIGNAL_SOURCE_INFOLOCATION, o)
+        self.output.flush()
+
+    def slot_startinfolocation(self, o):
+        self.emit(MELT_SIGNAL_INFOLOC_COMPLETE, o.marknum)
+
+    def slot_addinfolocation(self, o):
+        self.write({'type': 'infoloc', 'marknum': o.marknum, 'filenum': o.filenum, 'ident': o.ident, 'content': o.content})
+
+    def slot_getversion(self, obj):
+        self.write({'type': 'status', 'version': obj.version, 'rev': obj.rev})
+
+    def close(self):
+        self.output.flush()
+        if self.output is not sys.stdout:
+            self.output.close()
+
+class MeltSessionRecorder(QObject):
+    """
+    Fills a MeltSessionStore with what the dispatcher learns, committing
+    every COMMIT_INTERVAL milliseconds rather than on each event.
+    """
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, dispatcher, store):
+        QObject.__init__(self)
+        self.dispatcher = dispatcher
+        self.store = store
+        self.dirty = False
+
+        QObject.connect(self.dispatcher, MELT_SIGNAL_SOURCE_SHOWFILE, self.slot_showfile, Qt.QueuedConnection)
+        QObject.connect(self.dispatcher, MELT_SIGNAL_SOURCE_MARKLOCATIONS, self.slot_marklocations, Qt.QueuedConnection)
+        QObject.connect(self.dispatcher, MELT_SIGNAL_GETVERSION, self.slot_getversion, Qt.QueuedConnection)
+        self.timer = QTimer(self)
+        self.connect(self.timer, SIGNAL('timeout()'), self.slot_commit)
+        self.timer.start(self.COMMIT_INTERVAL)
+
+    def slot_showfile(self, o):
+        self.store.add_file(o)
+        route = self.dispatcher.get_route(o.filenum)
+        QObject.connect(route, MELT_SIGNAL_SOURCE_ADDINFOLOC, self.slot_addinfolocation, Qt.QueuedConnection)
+        self.dirty = True
+
+    def slot_marklocations(self, marks):
+        self.store.add_marks(marks)
+        self.dirty = True
+
+    def slot_addinfolocation(self, o):
+        self.store.add_infoloc(o)
+        self.dirty = True
+
+    def slot_getversion(self, obj):
+        self.store.set_status(obj)
+        self.dirty = True
+
+    def slot_commit(self):
+        if self.dirty:
+            self.dirty = False
+            self.store.commit()
+
+    def close(self):
+        self.timer.stop()
+        self.store.close()
+
+def connect_probe(comm, dispatcher, source_window, trace_window = None):
+    QObject.connect(comm, MELT_SIGNAL_DISPATCH_BATCH, dispatcher.slot_dispatchBatch, Qt.QueuedConnection)
+    QObject.connect(comm, MELT_SIGNAL_MELT_EXITED, dispatcher.slot_meltExited, Qt.QueuedConnection)
+    QObject.connect(comm, MELT_SIGNAL_REPLAY_DONE, dispatcher.slot_replayDone, Qt.QueuedConnection)
+    QObject.connect(dispatcher, MELT_SIGNAL_ASK_INFOLOCATION, comm.slot_sendInfoLocation, Qt.QueuedConnection)
+    QObject.connect(dispatcher, MELT_SIGNAL_SOURCE_MARKLOCATIONS, source_window.slot_marklocations, Qt.QueuedConnection)
+    QObject.connect(source_window, MELT_SIGNAL_SHOWFILE_COMPLETE, dispatcher.slot_showfileComplete, Qt.QueuedConnection)
+    QObject.connect(source_window, MELT_SIGNAL_SHOWFILE_FAILED, dispatcher.slot_showfileFailed, Qt.QueuedConnection)
+
+    if trace_window:
+        QObject.connect(dispatcher, MELT_SIGNAL_APPEND_TRACE_COMMANDS, trace_window.slot_appendCommands, Qt.QueuedConnection)
+        QObject.connect(comm, MELT_SIGNAL_APPEND_TRACE_REQUEST, trace_window.slot_appendRequest, Qt.QueuedConnection)
+
+    QObject.connect(dispatcher, MELT_SIGNAL_UNHANDLED_COMMAND, dispatcher.slot_unhandledCommand, Qt.QueuedConnection)
+
 class MeltProbeApplication(QApplication):
     TRACE_WINDOW = None
     SOURCE_WINDOW = None
+    STATS_WINDOW = None
+    SESSION_RECORDER = None
+    WORKER = None
 
     def __init__(self):
-        self.app = QApplication(sys.argv)
         self.parse_args()
 
+        if self.args.connect and self.args.command_from_MELT is not None and self.args.request_to_MELT is not None:
+            # Relaying takes neither Qt nor windows
+            if melt_relay(self.args.connect, self.args.command_from_MELT, self.args.request_to_MELT):
+                sys.exit(0)
+            logger.warning("No probe server on %(path)s, running standalone" % {'path': self.args.connect})
+
+        if self.args.replay and not os.environ.get('DISPLAY'):
+            # Replays are meant to run on machines without a display
+            os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        if self.args.headless:
+            self.app = QCoreApplication(self.qt_args)
+        else:
+            self.app = QApplication(self.qt_args)
+
         logger.setLevel(logging.ERROR)
         console.setLevel(logging.ERROR)
 
+        if (self.args.reader_stats or self.args.replay):
+            logger.setLevel(logging.INFO)
+            console.setLevel(logging.INFO)
+
         if (self.args.D):
             logger.setLevel(logging.DEBUG)
             console.setLevel(logging.DEBUG)
@@ -748,33 +3185,128 @@ class MeltProbeApplication(QApplication):
         self.main()
 
     def main(self):
-        dispatcher = MeltCommandDispatcher()
-        comm = MeltCommunication(self.args.command_from_MELT, self.args.request_to_MELT)
-        if (self.args.T):
-            self.TRACE_WINDOW = MeltTraceWindow()
-        self.SOURCE_WINDOW = MeltSourceWindow(dispatcher, comm)
-
-        QObject.connect(comm, MELT_SIGNAL_DISPATCH_COMMAND, dispatcher.slot_dispatchCommand, Qt.QueuedConnection)
-        QObject.connect(dispatcher, MELT_SIGNAL_ASK_INFOLOCATION, comm.slot_sendInfoLocation, Qt.QueuedConnection)
-        QObject.connect(dispatcher, MELT_SIGNAL_SOURCE_MARKLOCATION, self.SOURCE_WINDOW.slot_marklocation, Qt.QueuedConnection)
-        QObject.connect(self.SOURCE_WINDOW, MELT_SIGNAL_SHOWFILE_COMPLETE, dispatcher.slot_showfileComplete, Qt.QueuedConnection)
-
-        if (self.args.T):
-            QObject.connect(dispatcher, MELT_SIGNAL_APPEND_TRACE_COMMAND, self.TRACE_WINDOW.slot_appendCommand, Qt.QueuedConnection)
-            QObject.connect(comm, MELT_SIGNAL_APPEND_TRACE_REQUEST, self.TRACE_WINDOW.slot_appendRequest, Qt.QueuedConnection)
+        global METRICS
+        MeltSourceViewer.LARGE_FILE_THRESHOLD = self.args.large_file_threshold
+        if self.args.metrics or self.args.metrics_file or self.args.stats_window:
+            METRICS = MeltMetrics()
+        dispatcher = MeltCommandDispatcher(self.args.infoloc_cache * 1024 * 1024, self.args.prefetch_infolocs, self.args.queue_limit, self.args.queue_expiry, self.args.infoloc_index)
+        if not self.args.no_worker:
+            self.WORKER = MeltWorker(dispatcher)
+        if METRICS is not None:
+            METRICS.add_gauge('queue.marklocation', dispatcher.queued_marks)
+            METRICS.add_gauge('queue.infoloc', dispatcher.queued_infolocs)
+            METRICS.add_gauge('store.marks', dispatcher.stored_marks)
+            METRICS.add_gauge('store.bytes', dispatcher.STORE.nbytes)
+            METRICS.add_gauge('infoloc_index.postings', dispatcher.indexed_postings)
+            # Sampled from the GUI thread
+            METRICS.add_gauge('cpu.gui_s', thread_cpu_time)
+            if self.WORKER:
+                METRICS.add_gauge('cpu.worker_s', self.WORKER.cpu_time)
+            self.monitor = MeltEventLoopMonitor(METRICS, self.args.metrics_file)
+            if self.args.stats_window and not self.args.headless:
+                self.STATS_WINDOW = MeltStatsWindow(METRICS)
+        if self.args.open_session:
+            comm = MeltSessionCommunication(meltsession.MeltSessionStore(self.args.open_session), self.args.reader_stats, self.args.batch_size, self.args.batch_interval / 1000.0)
+        elif self.args.server:
+            comm = MeltServerCommunication(self.args.server, self.args.read_chunk_size, self.args.reader_stats, self.args.batch_size, self.args.batch_interval / 1000.0)
+        elif self.args.replay:
+            comm = MeltReplayCommunication(self.args.replay, self.args.replay_realtime, self.args.reader_stats, self.args.batch_size, self.args.batch_interval / 1000.0)
+            QObject.connect(dispatcher, MELT_SIGNAL_REPLAY_DONE, self.slot_replayDone, Qt.QueuedConnection)
+        else:
+            comm = MeltCommunication(self.args.command_from_MELT, self.args.request_to_MELT, self.args.read_chunk_size, self.args.reader_stats, self.args.batch_size, self.args.batch_interval / 1000.0)
+            QObject.connect(dispatcher, MELT_SIGNAL_MELT_EXITED, self.slot_meltExited, Qt.QueuedConnection)
+        if self.args.record:
+            comm.record_to(self.args.record)
+        if METRICS is not None:
+            METRICS.add_gauge('queue.requests', comm.queued_requests)
+        if self.args.session:
+            self.SESSION_RECORDER = MeltSessionRecorder(dispatcher, meltsession.MeltSessionStore(self.args.session, truncate = True))
+        if self.args.headless:
+            self.SOURCE_WINDOW = MeltHeadlessSink(dispatcher, comm, self.args.headless_output, self.args.headless_infolocs)
+        else:
+            if (self.args.T):
+                self.TRACE_WINDOW = MeltTraceWindow(self.args.trace_capacity, self.args.trace_refresh, self.args.trace_file)
+            self.SOURCE_WINDOW = MeltSourceWindow(dispatcher, comm, not self.args.no_search_index)
 
-        QObject.connect(dispatcher, MELT_SIGNAL_UNHANDLED_COMMAND, dispatcher.slot_unhandledCommand, Qt.QueuedConnection)
+        connect_probe(comm, dispatcher, self.SOURCE_WINDOW, self.TRACE_WINDOW)
 
+        if self.WORKER:
+            self.WORKER.start()
         comm.start()
-        sys.exit(self.app.exec_())
+        ret = self.app.exec_()
+        comm.close()
+        logger.info("CPU time: GUI thread %(gui).2fs, worker %(worker).2fs" % {'gui': thread_cpu_time(), 'worker': self.WORKER.cpu_time() if self.WORKER else 0})
+        if METRICS is not None:
+            METRICS.dump(self.args.metrics_file)
+        if self.WORKER:
+            self.WORKER.stop()
+        if not self.args.headless:
+            self.SOURCE_WINDOW.stop_search()
+        logger.info("Deferred queues: %(stats)s" % {'stats': ", ".join("%s=%d" % item for item in sorted(dispatcher.queue_stats.iteritems()))})
+        comm.close_record()
+        if self.SESSION_RECORDER:
+            self.SESSION_RECORDER.close()
+        if self.args.headless:
+            self.SOURCE_WINDOW.close()
+        if self.TRACE_WINDOW:
+            self.TRACE_WINDOW.close_log()
+        sys.exit(ret)
+
+    def slot_meltExited(self):
+        if self.args.headless:
+            # Nothing more will come, let the last batches through and quit
+            QTimer.singleShot(0, self.app.quit)
+
+    def slot_replayDone(self):
+        if self.args.replay_exit:
+            # Let the events posted while dispatching the last batches through
+            QTimer.singleShot(0, self.app.quit)
 
     def parse_args(self):
         self.parser = argparse.ArgumentParser(description="MELT probe")
         self.parser.add_argument("-T", action="store_true", required=False, help="Tracing mode")
         self.parser.add_argument("-D", action="store_true", required=False, help="Debug mode")
-        self.parser.add_argument("--command-from-MELT", type=int, required=True, help="FD to read from")
-        self.parser.add_argument("--request-to-MELT", type=int, required=True, help="FD to write to")
-        self.args = self.parser.parse_args()
+        self.parser.add_argument("--trace-capacity", type=int, default=MeltTraceWindow.CAPACITY, help="Number of protocol lines kept in the trace window")
+        self.parser.add_argument("--trace-refresh", type=float, default=MeltTraceWindow.REFRESH_RATE, help="Trace window refreshes per second")
+        self.parser.add_argument("--trace-file", required=False, help="Also append the whole trace to this file")
+        self.parser.add_argument("--command-from-MELT", type=int, required=False, help="FD to read from")
+        self.parser.add_argument("--request-to-MELT", type=int, required=False, help="FD to write to")
+        self.parser.add_argument("--record", required=False, help="Record the MELT session (commands and requests, with timestamps) to this file")
+        self.parser.add_argument("--replay", required=False, help="Replay a recorded MELT session instead of talking to MELT")
+        self.parser.add_argument("--replay-realtime", action="store_true", required=False, help="Replay at the original pace instead of as fast as possible")
+        self.parser.add_argument("--replay-exit", action="store_true", required=False, help="Quit once the recording has been replayed")
+        self.parser.add_argument("--server", required=False, help="Serve the compilers attaching to this Unix socket instead of talking to MELT")
+        self.parser.add_argument("--connect", required=False, help="Relay MELT to the probe server on this Unix socket, or run standalone if there is none")
+        self.parser.add_argument("--session", required=False, help="Store the files, marks and infolocs of the session in this SQLite database, replacing what it held")
+        self.parser.add_argument("--open-session", required=False, help="Browse a session stored with --session instead of talking to MELT")
+        self.parser.add_argument("--infoloc-cache", type=int, default=MeltCommandDispatcher.INFOLOC_CACHE_SIZE / (1024 * 1024), help="Memory budget in MB of the infoloc cache (0 disables it)")
+        self.parser.add_argument("--infoloc-index", type=int, default=MeltCommandDispatcher.INFOLOC_INDEX_SIZE, help="Postings (a token in the infolocs of a mark) kept by the infoloc query index (0 disables it)")
+        self.parser.add_argument("--prefetch-infolocs", action="store_true", required=False, help="Ask MELT for the infolocs of the marks near the cursor while it is idle")
+        self.parser.add_argument("--queue-limit", type=int, default=MeltCommandDispatcher.QUEUE_MARKS_LIMIT, help="Marks per file kept in memory while its SHOWFILE is pending, the rest is spilled to disk")
+        self.parser.add_argument("--queue-expiry", type=int, default=MeltCommandDispatcher.QUEUE_EXPIRY, help="Seconds after which deferred marks and infolocs still waiting are dropped (0 keeps them forever)")
+        self.parser.add_argument("--no-worker", action="store_true", required=False, help="Parse and dispatch the MELT commands on the GUI thread instead of a worker thread")
+        self.parser.add_argument("--no-search-index", action="store_true", required=False, help="Do not index the source files in the background for the search panel (Ctrl+Shift+F)")
+        self.parser.add_argument("--read-chunk-size", type=int, default=MeltLineReader.READ_CHUNK_SIZE, help="Size of the reads on the MELT command pipe (1 mimics the old byte per byte reader)")
+        self.parser.add_argument("--large-file-threshold", type=int, default=MeltSourceViewer.LARGE_FILE_THRESHOLD, help="Size in bytes above which source files are memory-mapped and loaded in the background, and not indexed for search")
+        self.parser.add_argument("--batch-size", type=int, default=MeltCommunication.BATCH_SIZE, help="Maximum number of commands delivered to the dispatcher at once (1 disables batching)")
+        self.parser.add_argument("--batch-interval", type=float, default=MeltCommunication.BATCH_INTERVAL * 1000, help="Maximum time in ms a command waits for its batch to be flushed")
+        self.parser.add_argument("--headless", action="store_true", required=False, help="Run without any window (-T and --stats-window are ignored), writing what MELT reports as JSON lines")
+        self.parser.add_argument("--headless-output", required=False, help="File the headless mode writes to (default: standard output)")
+        self.parser.add_argument("--headless-infolocs", action="store_true", required=False, help="In headless mode, ask MELT for the infolocs of every mark")
+        self.parser.add_argument("--metrics", action="store_true", required=False, help="Collect metrics, dumped as JSON on SIGUSR1 and at exit")
+        self.parser.add_argument("--metrics-file", required=False, help="Dump the metrics to this file instead of stderr (implies --metrics)")
+        self.parser.add_argument("--stats-window", action="store_true", required=False, help="Show the metrics in a live window (implies --metrics)")
+        self.parser.add_argument("--reader-stats", action="store_true", required=False, help="Periodically log reader throughput (bytes/s, lines/s)")
+        (self.args, extra) = self.parser.parse_known_args()
+        # Remaining arguments are left to Qt (-style, -display, ...)
+        unknown = [arg for arg in extra if arg.startswith("--")]
+        if unknown:
+            self.parser.error("unrecognized arguments: %(args)s" % {'args': " ".join(unknown)})
+        self.qt_args = [sys.argv[0]] + extra
+        if self.args.session and self.args.open_session:
+            self.parser.error("--session and --open-session are mutually exclusive")
+        if not (self.args.replay or self.args.open_session or self.args.server) and (self.args.command_from_MELT is None or self.args.request_to_MELT is None):
+            self.parser.error("--command-from-MELT and --request-to-MELT are required unless replaying, serving or opening a session")
 
 if __name__ == '__main__':
     mpa = MeltProbeApplication()